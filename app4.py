@@ -1,13 +1,31 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
-import requests
-from bs4 import BeautifulSoup
-from datetime import datetime
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+import aiohttp
+from bs4 import BeautifulSoup, SoupStrainer
+import soupsieve
+from datetime import datetime, timedelta, timezone
 from pony import orm
 import re
 import time
 import random
 import os
+import sys
+import argparse
 import logging
+import asyncio
+import threading
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+import atexit
+import gzip
+import hashlib
+import json
+import sqlite3
+import ssl
+import queue
+import heapq
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse, quote
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -38,6 +56,33 @@ class BookPrice(db.Entity):
     binding = orm.Optional(str, nullable=True)
     language = orm.Optional(str, nullable=True)
 
+# A product page fetch kept in the page archive, with what it was scraped as.
+# Rows saved from that scrape are found again by store, ISBN (or name) and time
+class ArchivedPage(db.Entity):
+    website = orm.Required(str)
+    url = orm.Required(str)
+    content_hash = orm.Required(str)
+    book_name = orm.Required(str)
+    isbn = orm.Optional(str, nullable=True)
+    fetched = orm.Required(datetime)
+
+# When each field group of a store's offer for an ISBN was last fetched (see
+# FIELD_GROUPS). Kept beside BookPrice so existing databases need no migration
+class OfferFreshness(db.Entity):
+    isbn = orm.Required(str)
+    website = orm.Required(str)
+    price_checked = orm.Optional(datetime, nullable=True)
+    metadata_checked = orm.Optional(datetime, nullable=True)
+    orm.composite_key(isbn, website)
+
+# Product page URL of a book at a store, so lookups by ISBN fetch it directly
+class ProductUrl(db.Entity):
+    website = orm.Required(str)
+    isbn = orm.Required(str)
+    url = orm.Required(str)
+    found = orm.Required(datetime)
+    orm.composite_key(website, isbn)
+
 db.generate_mapping(create_tables=True)
 
 # Headers for web requests - updated with more browser-like headers
@@ -88,6 +133,196 @@ def extract_price(text):
     logger.warning(f"Could not extract price from: {price_text}")
     return 0.0
 
+# HTML parser backend used by the store extractors: "html.parser" (pure
+# Python, always available), "lxml" (BeautifulSoup on lxml) or "selectolax"
+HTML_PARSER = os.environ.get("HTML_PARSER", "html.parser")
+PARSER_BACKENDS = ("html.parser", "lxml", "selectolax")
+
+class SelectolaxNode:
+    """BeautifulSoup-style view over a selectolax node.
+
+    Covers the subset of the bs4 Tag API the extractors use (select,
+    select_one, find, text, attrs, item access and parent) so the same CSS
+    selectors and extraction code run unchanged on the faster parser.
+    """
+
+    def __init__(self, node):
+        self.node = node
+
+    @classmethod
+    def wrap(cls, node):
+        return cls(node) if node is not None else None
+
+    @property
+    def text(self):
+        return self.node.text(deep=True)
+
+    @property
+    def attrs(self):
+        # selectolax reports valueless attributes as None, bs4 as ""
+        return {key: value if value is not None else "" for key, value in self.node.attributes.items()}
+
+    @property
+    def parent(self):
+        return SelectolaxNode.wrap(self.node.parent)
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+    def has_attr(self, key):
+        return key in self.node.attributes
+
+    def select_one(self, selector):
+        return SelectolaxNode.wrap(self.node.css_first(selector))
+
+    def select(self, selector):
+        return [SelectolaxNode(node) for node in self.node.css(selector)]
+
+    def find(self, name, string=None):
+        for node in self.node.css(name):
+            if string is None or string.search(node.text(deep=True)):
+                return SelectolaxNode(node)
+        return None
+
+# Partial parsing: build only the page regions a store extractor reads, and
+# run its regex fallbacks over their text instead of the whole document
+PARTIAL_PARSING = os.environ.get("PARTIAL_PARSING", "1") == "1"
+
+SIMPLE_SELECTOR = re.compile(r"^([a-zA-Z][\w-]*)?((?:[#.][\w-]+)*)(?:\[([\w-]+)(?:=['\"]?([^'\"\]]*)['\"]?)?\])?$")
+
+def page_regions(website, page):
+    """Region selectors for a store page, or None to parse the whole page."""
+    if not PARTIAL_PARSING:
+        return None
+    return STORE_REGISTRY[website].get("regions", {}).get(page)
+
+class RegionStrainer(SoupStrainer):
+    """SoupStrainer that keeps every top-level subtree matching a region selector.
+
+    BeautifulSoup only consults the strainer for tags outside an already kept
+    subtree, so each matching region is built whole and nothing else is.
+    """
+
+    def __init__(self, selectors):
+        super().__init__()
+        self.rules = []
+        for selector in selectors:
+            match = SIMPLE_SELECTOR.match(selector)
+            if not match:
+                raise ValueError(f"Region selector must be a simple selector: {selector}")
+            tag, qualifiers, attr, attr_value = match.groups()
+            ids = re.findall(r"#([\w-]+)", qualifiers)
+            self.rules.append((
+                tag.lower() if tag else None,
+                ids[0] if ids else None,
+                set(re.findall(r"\.([\w-]+)", qualifiers)),
+                attr,
+                attr_value,
+            ))
+
+    def matches_region(self, name, attrs):
+        attrs = attrs or {}
+        classes = attrs.get("class") or ""
+        classes = set(classes.split() if isinstance(classes, str) else classes)
+        for tag, tag_id, tag_classes, attr, attr_value in self.rules:
+            if tag and tag != name:
+                continue
+            if tag_id and attrs.get("id") != tag_id:
+                continue
+            if not tag_classes <= classes:
+                continue
+            if attr and (attr not in attrs or (attr_value is not None and attrs[attr] != attr_value)):
+                continue
+            return True
+        return False
+
+    def covers(self, compound):
+        """Whether an element written as a compound selector, e.g. "span.price", is a region."""
+        match = SIMPLE_SELECTOR.match(re.sub(r":[\w-]+(\([^)]*\))?", "", compound))
+        if not match:
+            return False
+        tag, qualifiers, attr, attr_value = match.groups()
+        attrs = {"class": re.findall(r"\.([\w-]+)", qualifiers)}
+        ids = re.findall(r"#([\w-]+)", qualifiers)
+        if ids:
+            attrs["id"] = ids[0]
+        if attr:
+            attrs[attr] = attr_value or ""
+        return self.matches_region(tag.lower() if tag else None, attrs)
+
+    # bs4 >= 4.13
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return self.matches_region(name, attrs)
+
+    # bs4 < 4.13
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        return self.matches_region(markup_name, dict(markup_attrs))
+
+class SelectolaxRegions:
+    """Root over the region nodes of a selectolax tree.
+
+    Mirrors a strained BeautifulSoup document: lookups and text only see the
+    declared regions, each region counted once even when regions nest.
+    """
+
+    def __init__(self, tree, regions):
+        self.tree = tree
+        self.kept = set()
+        self.nodes = []
+        # Nodes come back in document order, so an enclosing region is seen first
+        for node in tree.css(", ".join(regions)):
+            if not self.in_regions(node):
+                self.kept.add(node.mem_id)
+                self.nodes.append(node)
+
+    def in_regions(self, node):
+        while node is not None:
+            if node.mem_id in self.kept:
+                return True
+            node = node.parent
+        return False
+
+    @property
+    def text(self):
+        return "".join(node.text(deep=True) for node in self.nodes)
+
+    def select(self, selector):
+        return [SelectolaxNode(node) for node in self.tree.css(selector) if self.in_regions(node)]
+
+    def select_one(self, selector):
+        for node in self.tree.css(selector):
+            if self.in_regions(node):
+                return SelectolaxNode(node)
+        return None
+
+    def find(self, name, string=None):
+        for node in self.tree.css(name):
+            if self.in_regions(node) and (string is None or string.search(node.text(deep=True))):
+                return SelectolaxNode(node)
+        return None
+
+def make_soup(html, regions=None, backend=None):
+    """Parse html with the configured backend and return a bs4-style tree.
+
+    With regions, only the subtrees matching those selectors are built.
+    """
+    backend = backend or HTML_PARSER
+    if backend == "selectolax":
+        from selectolax.lexbor import LexborHTMLParser
+        tree = LexborHTMLParser(html)
+        if regions:
+            return SelectolaxRegions(tree, regions)
+        # An empty document has no root; parse a stub so lookups return None
+        return SelectolaxNode(tree.root if tree.root is not None else LexborHTMLParser("<html></html>").root)
+    if backend not in ("html.parser", "lxml"):
+        raise ValueError(f"Unknown HTML parser backend: {backend}")
+    if regions:
+        return BeautifulSoup(html, backend, parse_only=RegionStrainer(regions))
+    return BeautifulSoup(html, backend)
+
 def determine_genre(book_name, description):
     """Helper function to determine genre based on book name and description"""
     book_name = book_name.lower()
@@ -111,731 +346,2860 @@ def determine_genre(book_name, description):
         return "Children"
     return "Unknown"
 
-def amazon(session, headers, book_name):
-    search_url = f"https://www.amazon.in/s?k={'+'.join(book_name.split())}&i=stripbooks"
-    try:
-        logger.info(f"Searching Amazon for: {book_name}")
-        resp = session.get(search_url, headers=headers, timeout=10)
-        
-        # Debug the response
-        logger.info(f"Amazon response status: {resp.status_code}")
-        
-        soup = BeautifulSoup(resp.text, "html.parser")
-        
-        # Updated selector for Amazon's search results
-        book_link = soup.select_one("div.s-result-item h2 a")
-        if not book_link:
-            # Try alternative selectors
-            book_link = soup.select_one(".s-title-instructions-style a")
-            
-        if not book_link:
-            logger.warning("No book link found on Amazon")
-            # Save the HTML for debugging
-            with open("amazon_debug.html", "w", encoding="utf-8") as f:
-                f.write(resp.text)
-            logger.info("Saved Amazon HTML for debugging")
-            return book_name, "Unknown", "Unknown", "https://source.unsplash.com/random/300x400/?book", "amazon", 0.0, 0.0, "No description available", "Unknown", "Unknown", "Unknown"
-
-        # Get the book page URL
-        book_url = book_link['href']
-        if not book_url.startswith("https://"):
-            book_url = "https://www.amazon.in" + book_url
-        
-        # Fix for javascript:void(0) links
-        if "javascript:void" in book_url:
-            logger.warning("Found javascript:void link, trying alternative selector")
-            # Try alternative selectors
-            book_link = soup.select_one(".a-link-normal.s-underline-text.s-underline-link-text.s-link-style.a-text-normal")
-            if book_link:
-                book_url = book_link['href']
-                if not book_url.startswith("https://"):
-                    book_url = "https://www.amazon.in" + book_url
-            else:
-                logger.warning("No valid book link found on Amazon")
-                return book_name, "Unknown", "Unknown", "https://source.unsplash.com/random/300x400/?book", "amazon", 0.0, 0.0, "No description available", "Unknown", "Unknown", "Unknown"
-        
-        logger.info(f"Found book on Amazon: {book_url}")
-        
-        # Add a delay to avoid being blocked
-        time.sleep(2)
-        
-        # Get the book page
-        resp = session.get(book_url, headers=headers, timeout=10)
-        logger.info(f"Amazon book page status: {resp.status_code}")
-        
-        soup = BeautifulSoup(resp.text, "html.parser")
-
-        # Extract book title
-        title_element = soup.select_one("#productTitle")
-        book_name = title_element.text.strip() if title_element else book_name
-        logger.info(f"Extracted title: {book_name}")
-
-        # Try multiple price selectors
-        price = 0.0
-        price_selectors = [
-            ".a-price .a-offscreen",
-            ".a-price-whole", 
-            "span.a-price span.a-offscreen",
-            "#price span.a-color-price",
-            "#price",
-            ".kindle-price .a-color-price"
-        ]
-        
-        for selector in price_selectors:
-            price_elements = soup.select(selector)
-            for price_element in price_elements:
-                if price_element:
-                    price_text = price_element.text.strip()
-                    price = extract_price(price_text)
-                    if price > 0:
-                        logger.info(f"Extracted price: {price} using selector {selector}")
-                        break
-            if price > 0:
-                break
-        
-        if price == 0.0:
-            logger.warning("Could not extract price from Amazon")
-
-        # Extract author
-        author_element = soup.select_one("span.author a, a.contributorNameID")
-        author = author_element.text.strip() if author_element else "Unknown"
-        logger.info(f"Extracted author: {author}")
-
-        # Extract ISBN
-        isbn = "Unknown"
-        details = soup.select_one("#detailBullets_feature_div, .detail-bullet-list")
-        if details:
-            isbn_match = re.search(r'ISBN-13\D*(\d{3}-?\d{10}|\d{10})', details.text)
-            if not isbn_match:
-                isbn_match = re.search(r'ISBN\D*(\d{3}-?\d{10}|\d{10})', details.text)
-            isbn = isbn_match.group(1).replace("-", "") if isbn_match else "Unknown"
-        logger.info(f"Extracted ISBN: {isbn}")
-
-        # Extract rating
-        rating_element = soup.select_one("span[data-hook='rating-out-of-text'], #acrPopover")
-        rating = 0.0
-        if rating_element:
-            rating_text = rating_element.text.strip()
-            rating_match = re.search(r'(\d+(\.\d+)?)', rating_text)
-            rating = float(rating_match.group(1)) if rating_match else 0.0
-        logger.info(f"Extracted rating: {rating}")
-
-        # Extract description
-        description_element = soup.select_one("#bookDescription_feature_div, #productDescription, #feature-bullets")
-        description = description_element.text.strip() if description_element else "No description available"
-        logger.info(f"Extracted description: {description[:50]}...")
-
-        # Extract image URL
-        image_element = soup.select_one("#imgBlkFront, #landingImage, #ebooksImgBlkFront")
-        image_url = image_element['src'] if image_element and 'src' in image_element.attrs else "https://source.unsplash.com/random/300x400/?book"
-        if not image_url or image_url == "":
-            image_url = image_element['data-a-dynamic-image'] if image_element and 'data-a-dynamic-image' in image_element.attrs else "https://source.unsplash.com/random/300x400/?book"
-            if image_url and "{" in image_url:
-                # Extract the first URL from the JSON string
-                try:
-                    import json
-                    image_dict = json.loads(image_url)
-                    image_url = list(image_dict.keys())[0] if image_dict else "https://source.unsplash.com/random/300x400/?book"
-                except:
-                    image_url = "https://source.unsplash.com/random/300x400/?book"
-        logger.info(f"Extracted image URL: {image_url}")
-
-        # Extract genre and binding from description or categories
-        genre = "Unknown"
-        binding = "Unknown"
-        language = "Unknown"
-        
-        # Try to find genre from breadcrumbs or categories
-        breadcrumbs = soup.select("#wayfinding-breadcrumbs_feature_div a, #nav-subnav a")
-        for crumb in breadcrumbs:
-            crumb_text = crumb.text.strip()
-            if "Books" in crumb_text and crumb_text != "Books":
-                genre = crumb_text
-                logger.info(f"Found genre from breadcrumbs: {genre}")
-                break
-        
-        # Try to find binding and language from product details
-        detail_items = soup.select("#detailBullets_feature_div li, .detail-bullet-list li, .a-expander-content li")
-        for item in detail_items:
-            item_text = item.text.strip()
-            if "Binding" in item_text or "Format" in item_text:
-                binding_match = re.search(r'(Binding|Format):\s*([^:]+)', item_text)
-                binding = binding_match.group(2).strip() if binding_match else "Unknown"
-                logger.info(f"Found binding: {binding}")
-            elif "Language" in item_text:
-                language_match = re.search(r'Language:\s*([^:]+)', item_text)
-                language = language_match.group(1).strip() if language_match else "Unknown"
-                logger.info(f"Found language: {language}")
-
-        # If genre is still unknown, try to determine from book name and description
-        if genre == "Unknown":
-            genre = determine_genre(book_name, description)
-            logger.info(f"Determined genre from content: {genre}")
-
-        # Log the final data being returned
-        logger.info(f"Amazon scraping complete. Returning data for {book_name}")
-        return book_name, isbn, author, image_url, "amazon", price, rating, description, genre, binding, language
+# Order of the fields in a scraped offer tuple, as stored in BookPrice
+BOOK_FIELDS = ("book_name", "isbn", "author", "image_url", "website", "price", "rating",
+               "description", "genre", "binding", "language")
+
+# Value used for a field the store page did not yield
+FIELD_DEFAULTS = {
+    "isbn": "Unknown",
+    "author": "Unknown",
+    "image_url": "https://source.unsplash.com/random/300x400/?book",
+    "price": 0.0,
+    "rating": 0.0,
+    "description": "No description available",
+    "genre": "Unknown",
+    "binding": "Unknown",
+    "language": "Unknown",
+}
 
-    except Exception as e:
-        logger.error(f"Error scraping Amazon: {e}")
-        return book_name, "Unknown", "Unknown", "https://source.unsplash.com/random/300x400/?book", "amazon", 0.0, 0.0, "No description available", "Unknown", "Unknown", "Unknown"
+ISBN_PATTERN = r'(\d{3}-?\d{10}|\d{10})'
+PRICE_TEXT_PATTERNS = [
+    r'₹\s*([\d,]+\.?\d{0,2})',
+    r'Rs\.?\s*([\d,]+\.?\d{0,2})'
+]
+
+# Field extractors shared by the store configs. Parsers take the raw text or
+# attribute value of a matched element; page fallbacks take the parsed page.
+# Both return None when they find nothing, so the next step gets a go
+
+def positive_price(text):
+    price = extract_price(text)
+    return price if price > 0 else None
+
+def first_number(text):
+    match = re.search(r'(\d+(\.\d+)?)', text)
+    return float(match.group(1)) if match else None
+
+def clean_isbn(isbn):
+    """Digits of an ISBN, or None unless it is 10 or 13 digits long."""
+    isbn = re.sub(r'[^0-9]', '', isbn or "")
+    return isbn if len(isbn) in (10, 13) else None
+
+def isbn_from_text(text):
+    match = re.search(r'ISBN-13\D*' + ISBN_PATTERN, text) or re.search(r'ISBN\D*' + ISBN_PATTERN, text)
+    return clean_isbn(match.group(1)) if match else None
+
+def labelled_isbn(text):
+    for label in ("ISBN-13:", "ISBN:"):
+        if label in text:
+            return clean_isbn(text.split(label)[-1])
+    return None
+
+def regex_value(pattern, group=1):
+    """Parser returning a regex group from the element text."""
+    def parse(text):
+        match = re.search(pattern, text)
+        return match.group(group).strip() if match else None
+    return parse
+
+def after_label(label):
+    """Parser returning the text after a label such as "Binding:"."""
+    def parse(text):
+        return text.split(label)[-1].strip() if label in text else None
+    return parse
+
+def price_from_page_text(soup):
+    """Last resort: the first rupee amount in the parsed page text."""
+    logger.info("Trying direct text search for price")
+    for pattern in PRICE_TEXT_PATTERNS:
+        matches = re.findall(pattern, soup.text)
+        if matches:
+            try:
+                price = float(matches[0].replace(',', ''))
+                logger.info(f"Found price {price} using direct text search")
+                return price
+            except ValueError as e:
+                logger.warning(f"Error parsing price from direct text: {e}")
+    return None
 
-def bookswagon(session, headers, book_name):
-    search_url = "https://www.bookswagon.com/search-books/" + "-".join(book_name.split())
-    try:
-        logger.info(f"Searching Bookswagon for: {book_name}")
-        resp = session.get(search_url, headers=headers, timeout=10)
-        logger.info(f"Bookswagon response status: {resp.status_code}")
-        
-        soup = BeautifulSoup(resp.text, "html.parser")
-        
-        # Find the first book link
-        book_link = soup.select_one("div.title a")
-        if not book_link:
-            # Try alternative selector
-            book_link = soup.select_one(".product-title a")
-            
-        if not book_link:
-            logger.warning("No book link found on Bookswagon")
-            # Save the HTML for debugging
-            with open("bookswagon_debug.html", "w", encoding="utf-8") as f:
-                f.write(resp.text)
-            logger.info("Saved Bookswagon HTML for debugging")
-            return book_name, "Unknown", "Unknown", "https://source.unsplash.com/random/300x400/?book", "bookswagon", 0.0, 0.0, "No description available", "Unknown", "Unknown", "Unknown"
-
-        # Get the book page URL
-        book_url = book_link['href']
-        if not book_url.startswith("https://"):
-            book_url = "https://www.bookswagon.com" + book_url
-        logger.info(f"Found book on Bookswagon: {book_url}")
-        
-        # Add a delay to avoid being blocked
-        time.sleep(2)
-        
-        # Get the book page
-        resp = session.get(book_url, headers=headers, timeout=10)
-        logger.info(f"Bookswagon book page status: {resp.status_code}")
-        
-        soup = BeautifulSoup(resp.text, "html.parser")
-
-        # Extract book title - FIX: Clean up the title by removing newlines and extra text
-        title_element = soup.select_one("h1")
-        if title_element:
-            book_name = title_element.text.strip()
-            # Clean up the title - remove release date and format info
-            book_name = re.sub(r'\s*\|.*$', '', book_name)
-            book_name = re.sub(r'\s*$$.*?$$\s*$', '', book_name)
-            book_name = book_name.strip()
-        logger.info(f"Extracted title: {book_name}")
-
-        # Try multiple price selectors
-        price = 0.0
-        price_selectors = [
-            "div.price > div.sell",
-            "span#ctl00_phBody_ProductDetail_lblourPrice",
-            "label#ctl00_phBody_ProductDetail_lblourPrice",  # Added from app3.py
-            "label#ctl00_phBody_ProductDetail_lblDiscountPrice",
-            ".product-price",
-            ".our-price",
-            ".sell",
-            ".price-text",
-            "#site-wrapper .price"
+def isbn_from_page_text(soup):
+    return isbn_from_text(soup.text)
+
+def amazon_image(value):
+    # data-a-dynamic-image holds a JSON map of image URLs to sizes
+    if value.startswith("{"):
+        try:
+            return next(iter(json.loads(value)), None)
+        except ValueError:
+            return None
+    return value
+
+def amazon_books_category(text):
+    return text if "Books" in text and text != "Books" else None
+
+def bookswagon_title(text):
+    # Clean up the title - remove release date and format info
+    text = re.sub(r'\s*\|.*$', '', text)
+    text = re.sub(r'\s*$$.*?$$\s*$', '', text)
+    return text.strip() or None
+
+def bookswagon_category(element):
+    # Only links to category pages name a genre
+    return element.text.strip() if "-books" in element.get("href", "") else None
+
+def bookswagon_description(soup):
+    paragraphs = soup.select("div.col-sm-12 p")
+    return " ".join(p.text.strip() for p in paragraphs) or None
+
+def kitabay_price(element):
+    # Shopify's data-price is in paise
+    if element.has_attr('data-price'):
+        try:
+            return float(element['data-price']) / 100
+        except (ValueError, TypeError):
+            pass
+    return positive_price(element.text.strip())
+
+def kitabay_author(text):
+    parts = re.split(r'by', text, maxsplit=1, flags=re.IGNORECASE)
+    return parts[1].strip() if len(parts) > 1 else text
+
+def kitabay_isbn_paragraph(soup):
+    element = soup.find("p", string=re.compile("ISBN:"))
+    match = re.search(r'ISBN:\s*' + ISBN_PATTERN, element.text) if element else None
+    return clean_isbn(match.group(1)) if match else None
+
+def absolute_image_url(value):
+    return value if value.startswith("http") else "https:" + value
+
+def isbn10_to_13(isbn10):
+    core = "978" + isbn10[:9]
+    total = sum(int(digit) * (1 if i % 2 == 0 else 3) for i, digit in enumerate(core))
+    return core + str((10 - total % 10) % 10)
+
+def isbn13_to_10(isbn13):
+    """ISBN-10 of a 978 ISBN-13, or None (979 ISBNs have no ISBN-10)."""
+    if not re.fullmatch(r'978\d{10}', isbn13 or ""):
+        return None
+    core = isbn13[3:12]
+    check = (11 - sum((10 - i) * int(digit) for i, digit in enumerate(core)) % 11) % 11
+    return core + ("X" if check == 10 else str(check))
+
+def amazon_result_isbn(item):
+    # Printed books are listed under their ISBN-10 as the ASIN
+    asin = item.get("data-asin") or ""
+    return isbn10_to_13(asin) if re.fullmatch(r'\d{9}[\dX]', asin) else None
+
+def amazon_result_author(item):
+    # The byline reads "by <author> | <date>" under the title
+    for row in item.select("div.a-row.a-size-base.a-color-secondary"):
+        match = re.search(r'^\s*by\s+([^|]+)', row.text)
+        if match:
+            return " ".join(match.group(1).split())
+    return None
+
+def bookswagon_result_isbn(item):
+    # Product links end in the ISBN-13: /book/<slug>/<isbn>
+    for link in item.select("a"):
+        match = re.search(r'/(\d{13})(?:[/?#]|$)', link.get("href", ""))
+        if match:
+            return match.group(1)
+    return None
+
+KITABAY_DESCRIPTION = "div.product__description, .product-description"
+
+KITABAY_GENRES = {
+    "fiction": "Fiction",
+    "non-fiction": "Non-Fiction",
+    "biography": "Biography",
+    "autobiography": "Autobiography",
+    "mystery": "Mystery",
+    "thriller": "Thriller",
+    "romance": "Romance",
+    "science fiction": "Science Fiction",
+    "fantasy": "Fantasy",
+    "horror": "Horror",
+    "children": "Children's Books",
+    "young adult": "Young Adult",
+    "self-help": "Self-Help",
+    "business": "Business",
+    "history": "History"
+}
+
+KITABAY_BINDINGS = [
+    ("hardcover", "Hardcover"),
+    ("paperback", "Paperback"),
+    ("ebook", "E-Book"),
+    ("e-book", "E-Book"),
+]
+
+KITABAY_LANGUAGE_PATTERNS = [
+    r'language:\s*(\w+)',
+    r'in\s+(\w+)\s+language',
+    r'written in\s+(\w+)'
+]
+
+def kitabay_description_text(soup):
+    element = soup.select_one(KITABAY_DESCRIPTION)
+    return element.text.lower() if element else ""
+
+def kitabay_genre(soup):
+    desc_text = kitabay_description_text(soup)
+    for keyword, genre_name in KITABAY_GENRES.items():
+        if keyword in desc_text:
+            return genre_name
+    return None
+
+def kitabay_binding(soup):
+    desc_text = kitabay_description_text(soup)
+    for keyword, binding in KITABAY_BINDINGS:
+        if keyword in desc_text:
+            return binding
+    return None
+
+def kitabay_language(soup):
+    desc_text = kitabay_description_text(soup)
+    for pattern in KITABAY_LANGUAGE_PATTERNS:
+        match = re.search(pattern, desc_text)
+        if match:
+            return match.group(1).capitalize()
+    return None
+
+def kitabay_pick_link(soup, book_name):
+    """Pick the product link sharing the most words with book_name."""
+    book_links = []
+    book_name_parts = [part.lower() for part in book_name.split() if len(part) > 2]
+    for link in soup.select("a"):
+        href = link.get('href', '')
+        if '/products/' in href:
+            # Check if the link text or parent text contains parts of the book name
+            link_text = link.text.strip().lower()
+            parent_text = link.parent.text.strip().lower() if link.parent else ""
+            matches = sum(1 for part in book_name_parts if part in link_text or part in parent_text)
+            if matches > 0:
+                book_links.append((link, matches))
+
+    # Use the link with the most matches
+    book_links.sort(key=lambda x: x[1], reverse=True)
+    return book_links[0][0] if book_links else None
+
+# Store configs. Each store declares its URLs, the selectors that find the
+# product link on its search page, the page regions its extractors read, and
+# for every field an ordered list of steps. A step is either a selector step
+# (a dict) or a page fallback (a function of the parsed page); the first step
+# yielding a value wins. Selector steps take:
+#   selectors  CSS selectors tried in order
+#   multi      look at every match rather than only the first
+#   read       what to read from a match: "text" or "@attribute" (default text)
+#   parse      turns the read value into the field value
+#   extract    reads the field from the matched element itself instead
+# search_results describes the result cards of the search page: "items"
+# selects one card per listed book, "link" the product link inside it and
+# "fields" the steps run against each card (page fallbacks get the card).
+# "required" names the fields a card must carry for its offer to be kept
+# without fetching the product page.
+# "volatility" is how often the store's prices move relative to the others
+# (1.0 is typical); the refresh scheduler re-scrapes titles it sells sooner.
+# "isbn_url" builds a product page URL from an ISBN ({isbn13} or {isbn10});
+# stores without one are looked up by ISBN through their search page.
+# "freshness" overrides DEFAULT_FRESHNESS, the seconds after which the
+# store's prices and the rest of its offers (metadata) are re-fetched.
+# Adding a store is a matter of adding a config here.
+STORE_CONFIGS = [
+    {
+        "name": "amazon",
+        "label": "Amazon",
+        "base_url": "https://www.amazon.in",
+        "search_url": "{base_url}/s?k={query}&i=stripbooks",
+        # Printed books are listed under their ISBN-10 as the ASIN
+        "isbn_url": "{base_url}/dp/{isbn10}",
+        "query_separator": "+",
+        "rate_limit": (0.5, 2),
+        "cache_ttl": 15 * 60,
+        # Prices move several times a day (deals, third-party sellers)
+        "volatility": 1.5,
+        "freshness": {"price": 6 * 3600},
+        "search_links": [
+            "div.s-result-item h2 a",
+            ".s-title-instructions-style a",
+            ".a-link-normal.s-underline-text.s-underline-link-text.s-link-style.a-text-normal",
+        ],
+        "search_results": {
+            "items": "div.s-result-item[data-asin]:not([data-asin=''])",
+            "link": ["h2 a", "a.a-link-normal.s-link-style", "a.s-underline-link-text"],
+            "fields": {
+                "book_name": [{"selectors": ["h2 span", "h2"]}],
+                "price": [{"selectors": [".a-price .a-offscreen", ".a-price-whole"], "parse": positive_price}],
+                "isbn": [amazon_result_isbn],
+                "author": [amazon_result_author],
+                "rating": [{"selectors": ["span.a-icon-alt"], "parse": first_number}],
+                "image_url": [{"selectors": ["img.s-image"], "read": ["@src"]}],
+            },
+        },
+        "regions": {
+            "search": ["div.s-result-item", ".s-title-instructions-style", "a.s-underline-link-text"],
+            "product": [
+                "#productTitle", ".a-price", ".a-price-whole", "#price", ".kindle-price",
+                "span.author", "a.contributorNameID", "#detailBullets_feature_div", ".detail-bullet-list",
+                "span[data-hook]", "#acrPopover", "#bookDescription_feature_div", "#productDescription",
+                "#feature-bullets", "#imgBlkFront", "#landingImage", "#ebooksImgBlkFront",
+                "#wayfinding-breadcrumbs_feature_div", "#nav-subnav", ".a-expander-content",
+            ],
+        },
+        "fields": {
+            "book_name": [{"selectors": ["#productTitle"]}],
+            "price": [{
+                "selectors": [
+                    ".a-price .a-offscreen",
+                    ".a-price-whole",
+                    "span.a-price span.a-offscreen",
+                    "#price span.a-color-price",
+                    "#price",
+                    ".kindle-price .a-color-price",
+                ],
+                "multi": True,
+                "parse": positive_price,
+            }],
+            "author": [{"selectors": ["span.author a, a.contributorNameID"]}],
+            "isbn": [{"selectors": ["#detailBullets_feature_div, .detail-bullet-list"], "parse": isbn_from_text}],
+            "rating": [{"selectors": ["span[data-hook='rating-out-of-text'], #acrPopover"], "parse": first_number}],
+            "description": [{"selectors": ["#bookDescription_feature_div, #productDescription, #feature-bullets"]}],
+            "image_url": [{
+                "selectors": ["#imgBlkFront, #landingImage, #ebooksImgBlkFront"],
+                "read": ["@src", "@data-a-dynamic-image"],
+                "parse": amazon_image,
+            }],
+            "genre": [{
+                "selectors": ["#wayfinding-breadcrumbs_feature_div a, #nav-subnav a"],
+                "multi": True,
+                "parse": amazon_books_category,
+            }],
+            "binding": [{
+                "selectors": ["#detailBullets_feature_div li, .detail-bullet-list li, .a-expander-content li"],
+                "multi": True,
+                "parse": regex_value(r'(Binding|Format):\s*([^:]+)', group=2),
+            }],
+            "language": [{
+                "selectors": ["#detailBullets_feature_div li, .detail-bullet-list li, .a-expander-content li"],
+                "multi": True,
+                "parse": regex_value(r'Language:\s*([^:]+)'),
+            }],
+        },
+    },
+    {
+        "name": "bookswagon",
+        "label": "Bookswagon",
+        "base_url": "https://www.bookswagon.com",
+        "search_url": "{base_url}/search-books/{query}",
+        "query_separator": "-",
+        "rate_limit": (1.0, 2),
+        "cache_ttl": 60 * 60,
+        "volatility": 1.0,
+        "freshness": {"price": 12 * 3600},
+        "search_links": ["div.title a", ".product-title a"],
+        "search_results": {
+            "items": "div.list-view-books",
+            "link": ["div.title a", ".product-title a"],
+            "fields": {
+                "book_name": [{"selectors": ["div.title a", ".product-title a"], "parse": bookswagon_title}],
+                "price": [{"selectors": ["div.price div.sell", ".sell"], "parse": positive_price}],
+                "isbn": [bookswagon_result_isbn],
+                "author": [{"selectors": ["div.author-publisher a", ".author a"]}],
+                "image_url": [{"selectors": ["div.cover-image img", "img"], "read": ["@src", "@data-src"]}],
+            },
+        },
+        "regions": {
+            "search": ["div.list-view-books", "div.title", ".product-title"],
+            "product": [
+                "h1", "div.price", "#ctl00_phBody_ProductDetail_lblourPrice", "#ctl00_phBody_ProductDetail_lblDiscountPrice",
+                ".product-price", ".our-price", ".sell", ".price-text", ".price",
+                "#ctl00_phBody_ProductDetail_AuthorLink", ".author-name", ".author", "#ctl00_phBody_ProductDetail_lblAuthor1",
+                "#ctl00_phBody_ProductDetail_lblProductDetail", ".product-details", "ul.list-unstyled",
+                "div.starRating", ".rating", "#ctl00_phBody_ProductDetail_StarRating_LblAvgRate",
+                "#ctl00_phBody_ProductDetail_lblProductDesc", ".desc", "div.col-sm-12",
+                "#ctl00_phBody_ProductDetail_imgProduct", ".product-image", "a.themecolor", ".category-links", ".product-specs",
+                "a.contributorNameID",
+            ],
+        },
+        "fields": {
+            "book_name": [{"selectors": ["h1"], "parse": bookswagon_title}],
+            "price": [
+                {
+                    "selectors": [
+                        "div.price > div.sell",
+                        "span#ctl00_phBody_ProductDetail_lblourPrice",
+                        "label#ctl00_phBody_ProductDetail_lblourPrice",
+                        "label#ctl00_phBody_ProductDetail_lblDiscountPrice",
+                        ".product-price",
+                        ".our-price",
+                        ".sell",
+                        ".price-text",
+                        ".price",
+                    ],
+                    "multi": True,
+                    "parse": positive_price,
+                },
+                price_from_page_text,
+            ],
+            "author": [{
+                "selectors": [
+                    "#ctl00_phBody_ProductDetail_AuthorLink",
+                    ".author-name a",
+                    ".author a",
+                    "label#ctl00_phBody_ProductDetail_lblAuthor1 a",
+                    "a.contributorNameID",
+                ],
+            }],
+            "isbn": [
+                {"selectors": ["#ctl00_phBody_ProductDetail_lblProductDetail, .product-details"], "parse": isbn_from_text},
+                {
+                    "selectors": ["ul.list-unstyled.detailfont14.border-right li, ul.list-unstyled li"],
+                    "multi": True,
+                    "parse": labelled_isbn,
+                },
+            ],
+            "rating": [{
+                "selectors": ["div.starRating, .rating, span#ctl00_phBody_ProductDetail_StarRating_LblAvgRate"],
+                "read": ["@title", "text"],
+                "parse": first_number,
+            }],
+            "description": [
+                {"selectors": ["#ctl00_phBody_ProductDetail_lblProductDesc, .desc"]},
+                bookswagon_description,
+            ],
+            "image_url": [{"selectors": ["#ctl00_phBody_ProductDetail_imgProduct, .product-image img"], "read": ["@src"]}],
+            "genre": [{"selectors": ["a.themecolor, .category-links a"], "multi": True, "extract": bookswagon_category}],
+            "binding": [{
+                "selectors": ["ul.list-unstyled.detailfont14 li, ul.list-unstyled.detailfont14.border-right li, .product-specs li"],
+                "multi": True,
+                "parse": after_label("Binding:"),
+            }],
+            "language": [{
+                "selectors": ["ul.list-unstyled.detailfont14 li, ul.list-unstyled.detailfont14.border-right li, .product-specs li"],
+                "multi": True,
+                "parse": after_label("Language:"),
+            }],
+        },
+    },
+    {
+        "name": "kitabay",
+        "label": "Kitabay",
+        "base_url": "https://kitabay.com",
+        "search_url": "{base_url}/search?q={query}",
+        "query_separator": "+",
+        "rate_limit": (1.0, 2),
+        "cache_ttl": 60 * 60,
+        # Fixed list prices that rarely change
+        "volatility": 0.7,
+        "freshness": {"price": 24 * 3600, "metadata": 60 * 24 * 3600},
+        # Search results are scored against the book name rather than taking the first link
+        "pick_link": kitabay_pick_link,
+        # Result cards carry no ISBN, so the chosen book's page is still fetched
+        "search_results": {
+            "items": ".card-wrapper, .product-item, .grid-product",
+            "link": ["a[href*='/products/']"],
+            "fields": {
+                "book_name": [{"selectors": [".card__heading", ".product-item__title", ".grid-product__title"]}],
+                "price": [{
+                    "selectors": [".price-item--sale", ".price-item--regular", ".price-item", ".product-item__price", ".grid-product__price"],
+                    "multi": True,
+                    "extract": kitabay_price,
+                }],
+                "author": [{"selectors": [".card__vendor", ".product-item__vendor", ".grid-product__vendor"], "parse": kitabay_author}],
+                "image_url": [{"selectors": ["img"], "read": ["@src", "@data-src"], "parse": absolute_image_url}],
+            },
+        },
+        "regions": {
+            # The link picker scores every product link by its parent's text
+            "search": None,
+            "product": [
+                "h1", "p", "div.product__price", ".product-price", ".price-item", ".price--highlight", "[data-price]",
+                "div.product__inline__author", ".author-name", ".product-meta__vendor",
+                "div.product__description", ".product-details", ".product-description",
+                "div.product__image", ".product-featured-img", ".product-single__media",
+            ],
+        },
+        "fields": {
+            "book_name": [{"selectors": ["h1"]}],
+            "price": [
+                {
+                    "selectors": [
+                        "p.product__inline__price > span.price.on-sale",
+                        "p.product__inline__price > span.price",
+                        "div.product__price span.price",
+                        ".product-price",
+                        ".price-item",
+                        ".price--highlight",
+                        ".price-item--regular",
+                        "[data-price]",
+                    ],
+                    "multi": True,
+                    "extract": kitabay_price,
+                },
+                price_from_page_text,
+            ],
+            "author": [{
+                "selectors": ["div.product__inline__author, .author-name, .product-meta__vendor"],
+                "parse": kitabay_author,
+            }],
+            "isbn": [
+                kitabay_isbn_paragraph,
+                {"selectors": ["div.product__description, .product-details"], "parse": isbn_from_text},
+                isbn_from_page_text,
+            ],
+            "description": [{"selectors": [KITABAY_DESCRIPTION]}],
+            "image_url": [{
+                "selectors": ["div.product__image img, .product-featured-img, .product-single__media img"],
+                "read": ["@src", "@data-src"],
+                "parse": absolute_image_url,
+            }],
+            "genre": [kitabay_genre],
+            "binding": [kitabay_binding],
+            "language": [kitabay_language],
+        },
+    },
+]
+
+# Splits a selector into its compounds
+SELECTOR_COMBINATOR = re.compile(r"\s*[>+~]\s*|\s+")
+
+def check_region_selectors(config):
+    """Reject page selectors that partial parsing would silently stop matching.
+
+    A strained BeautifulSoup tree keeps each region without its ancestors,
+    while selectolax and a whole-page parse still see them. So a selector
+    reaching into the page through an ancestor must start at a region.
+    Search result fields are matched inside their result item and are not
+    checked.
+    """
+    fields = [
+        selector for steps in config["fields"].values() for step in steps if isinstance(step, dict)
+        for selector in step["selectors"]
+    ]
+    for page, selectors in (("product", fields), ("search", config.get("search_links", []))):
+        regions = config.get("regions", {}).get(page)
+        if not regions:
+            continue
+        strainer = RegionStrainer(regions)
+        for selector in selectors:
+            for part in selector.split(","):
+                compounds = SELECTOR_COMBINATOR.split(part.strip())
+                if len(compounds) > 1 and not strainer.covers(compounds[0]):
+                    raise ValueError(f"{config['name']} {page} selector '{part.strip()}' starts outside the page regions; "
+                                     f"add '{compounds[0]}' to them")
+
+def compile_selectors(selectors):
+    return [soupsieve.compile(selector) for selector in selectors]
+
+def compile_fields(fields):
+    return {
+        field: [
+            dict(step, selectors=compile_selectors(step["selectors"])) if isinstance(step, dict) else step
+            for step in steps
         ]
-        
-        for selector in price_selectors:
-            price_elements = soup.select(selector)
-            for price_element in price_elements:
-                if price_element:
-                    price_text = price_element.text.strip()
-                    logger.info(f"Found price element with text: {price_text}")
-                    price = extract_price(price_text)
-                    if price > 0:
-                        logger.info(f"Extracted price: {price} using selector {selector}")
-                        break
-            if price > 0:
+        for field, steps in fields.items()
+    }
+
+def compile_store(config):
+    """Copy of a store config with every CSS selector precompiled."""
+    compiled = dict(config)
+    compiled["search_links"] = compile_selectors(config.get("search_links", []))
+    compiled["fields"] = compile_fields(config["fields"])
+    if config.get("search_results"):
+        results = config["search_results"]
+        compiled["search_results"] = dict(
+            results,
+            items=soupsieve.compile(results["items"]),
+            link=compile_selectors(results["link"]),
+            fields=compile_fields(results["fields"]),
+        )
+    return compiled
+
+# Registered stores by name, with selectors compiled once at startup
+STORE_REGISTRY = {}
+
+def parse_store_base_urls(value):
+    """Parse "store=url,store=url" into a {store: url} mapping."""
+    overrides = {}
+    for entry in value.split(","):
+        if "=" in entry:
+            name, url = entry.split("=", 1)
+            overrides[name.strip()] = url.strip().rstrip("/")
+    return overrides
+
+# Point stores somewhere other than the live site, e.g. at mock_stores.py:
+# STORE_BASE_URLS="amazon=http://127.0.0.1:8901,kitabay=http://127.0.0.1:8903"
+STORE_BASE_URLS = parse_store_base_urls(os.environ.get("STORE_BASE_URLS", ""))
+# Rate limit for stores moved by STORE_BASE_URLS, as "rate,burst"; unset
+# keeps each store's own politeness budget
+OVERRIDE_RATE_LIMIT = os.environ.get("OVERRIDE_RATE_LIMIT")
+
+def register_store(config):
+    check_region_selectors(config)
+    compiled = compile_store(config)
+    if config["name"] in STORE_BASE_URLS:
+        compiled["base_url"] = STORE_BASE_URLS[config["name"]]
+        if OVERRIDE_RATE_LIMIT:
+            rate, burst = OVERRIDE_RATE_LIMIT.split(",")
+            compiled["rate_limit"] = (float(rate), int(burst))
+        logger.info(f"Store {config['name']} pointed at {compiled['base_url']}")
+    STORE_REGISTRY[config["name"]] = compiled
+
+for store_config in STORE_CONFIGS:
+    register_store(store_config)
+
+def css_select(node, pattern):
+    # selectolax trees take the selector text, bs4 trees the compiled pattern
+    if isinstance(node, (SelectolaxNode, SelectolaxRegions)):
+        return node.select(pattern.pattern)
+    return pattern.select(node)
+
+def css_select_one(node, pattern):
+    if isinstance(node, (SelectolaxNode, SelectolaxRegions)):
+        return node.select_one(pattern.pattern)
+    return pattern.select_one(node)
+
+def store_search_url(website, book_name):
+    config = STORE_REGISTRY[website]
+    query = config["query_separator"].join(quote(word) for word in book_name.split())
+    return config["search_url"].format(base_url=config["base_url"], query=query)
+
+def isbn_product_url(website, isbn):
+    """Product page URL a store builds from an ISBN, or None."""
+    config = STORE_REGISTRY[website]
+    isbn10 = isbn13_to_10(isbn)
+    if not config.get("isbn_url") or ("{isbn10}" in config["isbn_url"] and not isbn10):
+        return None
+    return config["isbn_url"].format(base_url=config["base_url"], isbn13=isbn, isbn10=isbn10)
+
+def absolute_url(website, href):
+    return href if href.startswith("https://") else STORE_REGISTRY[website]["base_url"] + href
+
+def find_book_url(website, html, book_name, soup=None):
+    """Pick the product page URL for book_name from a store search page."""
+    config = STORE_REGISTRY[website]
+    if soup is None:
+        soup = make_soup(html, page_regions(website, "search"))
+
+    book_link = None
+    if config.get("pick_link"):
+        book_link = config["pick_link"](soup, book_name)
+    else:
+        for pattern in config["search_links"]:
+            link = css_select_one(soup, pattern)
+            # Skip javascript:void(0) placeholders and try the next selector
+            if link and link.get('href') and "javascript:void" not in link['href']:
+                book_link = link
                 break
-        
-        # Try direct text search for price if selectors fail
-        if price == 0.0:
-            logger.info("Trying direct text search for price")
-            price_patterns = [
-                r'₹\s*([\d,]+\.?\d{0,2})',
-                r'Rs\.?\s*([\d,]+\.?\d{0,2})'
-            ]
-            
-            for pattern in price_patterns:
-                matches = re.findall(pattern, soup.text)
-                if matches:
-                    try:
-                        price_str = matches[0]
-                        if isinstance(price_str, tuple):
-                            price_str = price_str[0]
-                        price = float(price_str.replace(',', ''))
-                        logger.info(f"Found price {price} using direct text search")
+
+    if not book_link:
+        logger.warning(f"No book link found on {config['label']}")
+        # Keep a snapshot of the page for debugging
+        debug_capture.capture(website, store_search_url(website, book_name), html, "no book link")
+        return None
+
+    book_url = absolute_url(website, book_link['href'])
+    logger.info(f"Found book on {config['label']}: {book_url}")
+    return book_url
+
+def read_element(element, step):
+    if "extract" in step:
+        return step["extract"](element)
+    parse = step.get("parse")
+    for source in step.get("read", ["text"]):
+        raw = element.text.strip() if source == "text" else element.get(source[1:])
+        if raw:
+            value = parse(raw) if parse else raw
+            if value not in (None, ""):
+                return value
+    return None
+
+def run_field_steps(soup, steps):
+    """Run a field's steps in order and return the first value found."""
+    for step in steps:
+        if callable(step):
+            value = step(soup)
+        else:
+            value = None
+            for pattern in step["selectors"]:
+                if step.get("multi"):
+                    elements = css_select(soup, pattern)
+                else:
+                    element = css_select_one(soup, pattern)
+                    elements = [element] if element is not None else []
+                for element in elements:
+                    value = read_element(element, step)
+                    if value not in (None, ""):
                         break
-                    except (ValueError, IndexError) as e:
-                        logger.warning(f"Error parsing price from direct text: {e}")
-                        continue
-
-        # Extract author - improved from app3.py
-        author = "Unknown"
-        author_selectors = [
-            "#ctl00_phBody_ProductDetail_AuthorLink", 
-            ".author-name a",
-            ".author a",
-            "label#ctl00_phBody_ProductDetail_lblAuthor1 a",  # Added from app3.py
-            "span.a-list-item a.contributorNameID"
-        ]
-        
-        for selector in author_selectors:
-            author_element = soup.select_one(selector)
-            if author_element:
-                author = author_element.text.strip()
-                logger.info(f"Extracted author: {author}")
+                if value not in (None, ""):
+                    break
+        if value not in (None, ""):
+            return value
+    return None
+
+def offer_tuple(fields):
+    """Offer tuple in BOOK_FIELDS order, guessing the genre if none was found."""
+    # If genre is still unknown, try to determine from book name and description
+    if fields["genre"] == "Unknown":
+        fields["genre"] = determine_genre(fields["book_name"], fields["description"])
+        logger.info(f"Determined genre from content: {fields['genre']}")
+    return tuple(fields[field] for field in BOOK_FIELDS)
+
+def parse_product(website, html, book_name):
+    """Extract an offer tuple from a store product page."""
+    return extract_product(website, make_soup(html, page_regions(website, "product")), book_name)
+
+def extract_product(website, soup, book_name):
+    """Extract an offer tuple from a parsed store product page."""
+    config = STORE_REGISTRY[website]
+    fields = dict(FIELD_DEFAULTS, book_name=book_name, website=website)
+    for field, steps in config["fields"].items():
+        value = run_field_steps(soup, steps)
+        if value is not None:
+            fields[field] = value
+        logger.info(f"Extracted {field}: {str(fields[field])[:50]}")
+
+    offer = offer_tuple(fields)
+    logger.info(f"{config['label']} scraping complete. Returning data for {fields['book_name']}")
+    return offer
+
+# Search-page harvesting: keep an offer for every book listed on a store's
+# search page and only fetch a product page when the top result is missing
+# a required field. Set SEARCH_PAGE_HARVEST=0 to always fetch it instead
+SEARCH_PAGE_HARVEST = os.environ.get("SEARCH_PAGE_HARVEST", "1") == "1"
+# Most result cards kept per store search page
+SEARCH_HARVEST_LIMIT = int(os.environ.get("SEARCH_HARVEST_LIMIT", "10"))
+# Fields a result card must carry to stand in for the product page
+SEARCH_REQUIRED_FIELDS = ("book_name", "isbn", "price")
+
+def harvest_search_results(website, soup):
+    """Read every result card on a parsed search page.
+
+    Returns (product URL, fields) pairs in page order, one per listed book.
+    """
+    results = STORE_REGISTRY[website]["search_results"]
+    harvested = []
+    seen = set()
+    for item in css_select(soup, results["items"]):
+        url = None
+        for pattern in results["link"]:
+            link = css_select_one(item, pattern)
+            if link and link.get('href') and "javascript:void" not in link['href']:
+                url = absolute_url(website, link['href'])
                 break
+        # Cards can nest (wrapper and inner card), so keep one per product
+        if not url or url in seen:
+            continue
+        seen.add(url)
+
+        fields = dict(FIELD_DEFAULTS, book_name=None, website=website)
+        for field, steps in results["fields"].items():
+            value = run_field_steps(item, steps)
+            if value is not None:
+                fields[field] = value
+        if fields["book_name"]:
+            harvested.append((url, fields))
+        if len(harvested) >= SEARCH_HARVEST_LIMIT:
+            break
+    return harvested
+
+# Fields a result card needs when only the price is being refreshed; the
+# offer's ISBN and metadata are already known
+PRICE_ONLY_FIELDS = ("book_name", "price")
+
+class CardOffer(tuple):
+    """Offer read from a search result card alone.
+
+    Cards are trusted for prices; their metadata is not counted as fetched
+    (see record_checked).
+    """
+
+def missing_fields(website, fields, required=None):
+    required = required or STORE_REGISTRY[website]["search_results"].get("required", SEARCH_REQUIRED_FIELDS)
+    return [field for field in required if fields.get(field) in (None, "", FIELD_DEFAULTS.get(field))]
+
+def search_page_offers(website, html, book_name, required=None, fetch_product=False):
+    """Offers harvested from a store search page, and the product URL to fetch.
+
+    The URL is None when there is nothing to fetch: either nothing was found
+    or the top result already carries every required field (the store's
+    "required", unless overridden) and fetch_product is not set. When it is
+    set, the product page offer replaces the top result's.
+    """
+    config = STORE_REGISTRY[website]
+    soup = make_soup(html, page_regions(website, "search"))
+    if not SEARCH_PAGE_HARVEST or not config.get("search_results"):
+        return [], find_book_url(website, html, book_name, soup)
+
+    harvested = harvest_search_results(website, soup)
+    if not harvested:
+        return [], find_book_url(website, html, book_name, soup)
+
+    # The store's own pick for the query is the top result
+    book_url = find_book_url(website, html, book_name, soup)
+    top = next((i for i, (url, _) in enumerate(harvested) if url == book_url), 0)
+    top_url, top_fields = harvested[top]
+    missing = missing_fields(website, top_fields, required)
+    logger.info(f"Harvested {len(harvested)} offers from {config['label']} search page")
+
+    offers = [CardOffer(offer_tuple(fields)) for i, (_, fields) in enumerate(harvested) if i != top]
+    if missing or fetch_product:
+        logger.info(f"{config['label']} search result lacks {', '.join(missing)}, fetching {top_url}")
+        return offers, top_url
+    return [CardOffer(offer_tuple(top_fields))] + offers, None
+
+# Timeout for a single store request, in seconds
+FETCH_TIMEOUT = 10
+# Seconds a store fetch may run past the caller's deadline, so stores that
+# miss it can still finish in the background and have their offers saved
+STRAGGLER_GRACE = 5
+
+def fetch_timeout(deadline=None, website=None):
+    """Timeout for one store request: the store's adaptive timeout, capped by a
+    time.monotonic() deadline."""
+    timeout = store_latency.timeout_for(website) if website else FETCH_TIMEOUT
+    if deadline is None:
+        return timeout
+    return max(0.1, min(timeout, deadline - time.monotonic() + STRAGGLER_GRACE))
+# Upper bound on store requests in flight on the scrape engine at once
+MAX_CONCURRENT_FETCHES = 100
+
+# Store each scraped host belongs to, for per-store pools and metrics
+STORE_HOSTS = {urlparse(config["base_url"]).netloc: name for name, config in STORE_REGISTRY.items()}
+
+def store_for_url(url):
+    host = urlparse(url).netloc
+    return STORE_HOSTS.get(host, host)
+
+class ScraperMetrics:
+    """Thread-safe per-store counters, served by /scraper-metrics."""
+
+    def __init__(self):
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def incr(self, website, name, amount=1):
+        with self._lock:
+            store = self.counters.setdefault(website, {})
+            store[name] = store.get(name, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return {website: dict(counts) for website, counts in self.counters.items()}
+
+scraper_metrics = ScraperMetrics()
+
+# Adaptive timeouts: once a store has LATENCY_MIN_SAMPLES recent responses,
+# its requests time out at ADAPTIVE_TIMEOUT_FACTOR times its p99 latency,
+# kept between MIN_FETCH_TIMEOUT and FETCH_TIMEOUT
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+ADAPTIVE_TIMEOUT_FACTOR = 2
+MIN_FETCH_TIMEOUT = 2
+# Hedged requests: when an async request outlives the store's p95 latency a
+# second copy is sent if the host has a spare rate limit token, and the first
+# response to come back wins
+HEDGE_REQUESTS = os.environ.get("HEDGE_REQUESTS", "0") == "1"
+
+class LatencyTracker:
+    """Recent response times per store, for adaptive timeouts and hedging."""
+
+    def __init__(self, window=LATENCY_WINDOW, min_samples=LATENCY_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, website, seconds):
+        with self._lock:
+            if website not in self.samples:
+                self.samples[website] = deque(maxlen=self.window)
+            self.samples[website].append(seconds)
+
+    def percentile(self, website, pct):
+        """pct-th percentile of the store's recent latencies, or None without enough samples."""
+        with self._lock:
+            samples = sorted(self.samples.get(website, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+    def timeout_for(self, website):
+        p99 = self.percentile(website, 99)
+        if p99 is None:
+            return FETCH_TIMEOUT
+        return min(FETCH_TIMEOUT, max(MIN_FETCH_TIMEOUT, p99 * ADAPTIVE_TIMEOUT_FACTOR))
+
+    def hedge_delay(self, website):
+        """Seconds to wait before hedging a request, or None to not hedge."""
+        return self.percentile(website, 95) if HEDGE_REQUESTS else None
+
+    def snapshot(self):
+        with self._lock:
+            websites = list(self.samples)
+        stats = {}
+        for website in websites:
+            stats[website] = {
+                'latency_p50': self.percentile(website, 50),
+                'latency_p95': self.percentile(website, 95),
+                'latency_p99': self.percentile(website, 99),
+                'fetch_timeout': self.timeout_for(website),
+            }
+        return stats
 
-        # Extract ISBN - improved from app3.py
-        isbn = "Unknown"
-        # First try to find ISBN in the product details section
-        details = soup.select_one("#ctl00_phBody_ProductDetail_lblProductDetail, .product-details")
-        if details:
-            isbn_match = re.search(r'ISBN-13\D*(\d{3}-?\d{10}|\d{10})', details.text)
-            if not isbn_match:
-                isbn_match = re.search(r'ISBN\D*(\d{3}-?\d{10}|\d{10})', details.text)
-            isbn = isbn_match.group(1).replace("-", "") if isbn_match else "Unknown"
-        
-        # If ISBN is still unknown, try to find it in list items
-        if isbn == "Unknown":
-            for li in soup.select("ul.list-unstyled.detailfont14.border-right li, ul.list-unstyled li"):
-                text = li.text.strip()
-                if "ISBN-13:" in text:
-                    isbn = text.split("ISBN-13:")[-1].strip()
-                    break
-                elif "ISBN:" in text:
-                    isbn = text.split("ISBN:")[-1].strip()
-                    break
-        
-        # Clean up the ISBN
-        if isbn != "Unknown":
-            # Remove any non-digit characters
-            isbn = re.sub(r'[^0-9]', '', isbn)
-            # Ensure it's a valid ISBN length (10 or 13 digits)
-            if len(isbn) not in [10, 13]:
-                isbn = "Unknown"
-        
-        logger.info(f"Extracted ISBN: {isbn}")
-
-        # Extract rating - improved from app3.py
-        rating_element = soup.select_one("div.starRating, .rating, span#ctl00_phBody_ProductDetail_StarRating_LblAvgRate")
-        rating = 0.0
-        if rating_element:
-            if rating_element.get("title"):
-                rating_text = rating_element["title"]
-                rating_match = re.search(r'(\d+(\.\d+)?)', rating_text)
-                rating = float(rating_match.group(1)) if rating_match else 0.0
+store_latency = LatencyTracker()
+
+# Politeness budget per store host as (requests per second, burst size). A
+# burst of 2 lets one lookup fetch its search and product page back to back
+DEFAULT_RATE_LIMIT = (0.5, 2)
+HOST_RATE_LIMITS = {
+    urlparse(config["base_url"]).netloc: config["rate_limit"]
+    for config in STORE_REGISTRY.values() if "rate_limit" in config
+}
+# Point this at a sqlite file to share host budgets between processes
+# (e.g. several gunicorn workers); leave unset for a per-process limiter
+RATE_LIMIT_DB = os.environ.get("RATE_LIMIT_DB")
+
+class TokenBucket:
+    """Thread-safe token bucket for a single host."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return how long to wait before it may be used.
+
+        Tokens can go negative, which queues callers behind each other so
+        each one waits exactly as long as the host's budget requires.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def try_take(self):
+        """Take a token only if one is free right now."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class SqliteTokenBucket:
+    """Token bucket kept in a sqlite file so several processes share it."""
+
+    def __init__(self, path, host, rate, burst):
+        self.path = path
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        with sqlite3.connect(self.path, timeout=10) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS rate_buckets (host TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def reserve(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try:
+            # Wall clock time, since monotonic clocks are not shared between processes
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE host = ?", (self.host,)).fetchone()
+            tokens = float(self.burst) if row is None else min(self.burst, row[0] + (now - row[1]) * self.rate)
+            tokens -= 1
+            conn.execute("INSERT OR REPLACE INTO rate_buckets (host, tokens, updated) VALUES (?, ?, ?)", (self.host, tokens, now))
+            conn.execute("COMMIT")
+            return 0.0 if tokens >= 0 else -tokens / self.rate
+        finally:
+            conn.close()
+
+    def try_take(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE host = ?", (self.host,)).fetchone()
+            tokens = float(self.burst) if row is None else min(self.burst, row[0] + (now - row[1]) * self.rate)
+            if tokens < 1:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("INSERT OR REPLACE INTO rate_buckets (host, tokens, updated) VALUES (?, ?, ?)", (self.host, tokens - 1, now))
+            conn.execute("COMMIT")
+            return True
+        finally:
+            conn.close()
+
+class HostRateLimiter:
+    """Process-wide per-host rate limiter shared by every scrape on the engine loop."""
+
+    def __init__(self, limits, default, db_path=None):
+        self.limits = limits
+        self.default = default
+        self.db_path = db_path
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, host):
+        with self._lock:
+            if host not in self.buckets:
+                rate, burst = self.limits.get(host, self.default)
+                if self.db_path:
+                    self.buckets[host] = SqliteTokenBucket(self.db_path, host, rate, burst)
+                else:
+                    self.buckets[host] = TokenBucket(rate, burst)
+            return self.buckets[host]
+
+    def reserve(self, url):
+        host = urlparse(url).netloc
+        delay = self.bucket(host).reserve()
+        if delay > 0:
+            logger.info(f"Rate limiting {host}: waiting {delay:.2f}s")
+        return delay
+
+    async def acquire_async(self, url):
+        """Wait on the event loop until the host of url has budget for one more request."""
+        # The sqlite bucket blocks while other processes hold its lock, so it
+        # is kept off the event loop; the in-memory one only takes a thread lock
+        delay = await asyncio.to_thread(self.reserve, url) if self.db_path else self.reserve(url)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def try_acquire(self, url):
+        """Take a token for url's host without waiting; False if none is free."""
+        return self.bucket(urlparse(url).netloc).try_take()
+
+    async def try_acquire_async(self, url):
+        """try_acquire for the event loop."""
+        if self.db_path:
+            return await asyncio.to_thread(self.try_acquire, url)
+        return self.try_acquire(url)
+
+rate_limiter = HostRateLimiter(HOST_RATE_LIMITS, DEFAULT_RATE_LIMIT, RATE_LIMIT_DB)
+
+# On-disk cache of store responses, keyed by URL
+HTTP_CACHE_DIR = os.environ.get("HTTP_CACHE_DIR", "http_cache")
+HTTP_CACHE_MAX_BYTES = 200 * 1024 * 1024
+# How long a cached page is served without asking the store, in seconds
+DEFAULT_HTTP_CACHE_TTL = 30 * 60
+HTTP_CACHE_TTLS = {
+    urlparse(config["base_url"]).netloc: config["cache_ttl"]
+    for config in STORE_REGISTRY.values() if "cache_ttl" in config
+}
+
+class HttpCache:
+    """Size-bounded on-disk cache of store pages.
+
+    Each entry is a gzipped JSON file holding the body and the validators
+    (ETag/Last-Modified) needed to revalidate it once its TTL has passed.
+    File mtimes double as last-use times for least-recently-used eviction.
+    """
+
+    def __init__(self, directory, max_bytes, ttls, default_ttl):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.total_bytes = None
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json.gz")
+
+    def ttl(self, url):
+        return self.ttls.get(urlparse(url).netloc, self.default_ttl)
+
+    def lookup(self, url):
+        """Return the cached entry for url, or None."""
+        path = self.path(url)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                entry = json.load(f)
+            # Mark the entry as recently used for eviction
+            os.utime(path)
+            return entry
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Dropping unreadable cache entry for {url}: {e}")
+            self._remove(path)
+            return None
+
+    def is_fresh(self, entry):
+        return time.time() - entry["fetched_at"] < self.ttl(entry["url"])
+
+    def conditional_headers(self, entry):
+        """Request headers that let the store answer 304 Not Modified."""
+        conditional = {}
+        if entry and entry.get("etag"):
+            conditional["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            conditional["If-Modified-Since"] = entry["last_modified"]
+        return conditional
+
+    def store(self, url, body, response_headers):
+        entry = {
+            "url": url,
+            "fetched_at": time.time(),
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified"),
+            "body": body,
+        }
+        self._write(entry)
+        return entry
+
+    def revalidated(self, entry, response_headers):
+        """Restart an entry's TTL after the store answered 304."""
+        entry["fetched_at"] = time.time()
+        entry["etag"] = response_headers.get("ETag") or entry.get("etag")
+        entry["last_modified"] = response_headers.get("Last-Modified") or entry.get("last_modified")
+        self._write(entry)
+        return entry
+
+    def _write(self, entry):
+        path = self.path(entry["url"])
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(entry, f)
+        with self._lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            if self.total_bytes is None:
+                self.total_bytes = self._disk_usage()
             else:
-                rating_text = rating_element.text.strip()
-                if rating_text and rating_text != "Not Rated":
-                    rating_match = re.search(r'(\d+(\.\d+)?)', rating_text)
-                    rating = float(rating_match.group(1)) if rating_match else 0.0
-        logger.info(f"Extracted rating: {rating}")
-
-        # Extract description - improved from app3.py
-        description_element = soup.select_one("#ctl00_phBody_ProductDetail_lblProductDesc, .desc")
-        if not description_element:
-            description_elements = soup.select("div.col-sm-12 p")
-            description = " ".join([p.text.strip() for p in description_elements]) if description_elements else "No description available"
-        else:
-            description = description_element.text.strip()
-        logger.info(f"Extracted description: {description[:50]}...")
-
-        # Extract image URL
-        image_element = soup.select_one("#ctl00_phBody_ProductDetail_imgProduct, .product-image img")
-        image_url = image_element['src'] if image_element and 'src' in image_element.attrs else "https://source.unsplash.com/random/300x400/?book"
-        logger.info(f"Extracted image URL: {image_url}")
-
-        # Extract genre from themecolor links - from app3.py
-        genre = "Unknown"
-        for a_tag in soup.select("a.themecolor, .category-links a"):
-            if "-books" in a_tag.get("href", ""):  # Check if it's a category page
-                genre = a_tag.text.strip()
-                logger.info(f"Found genre: {genre}")
-                break  # Stop at the first valid genre
-
-        # Extract binding and language - from app3.py
-        binding = "Unknown"
-        language = "Unknown"
-        for li in soup.select("ul.list-unstyled.detailfont14 li, ul.list-unstyled.detailfont14.border-right li, .product-specs li"):
-            text = li.text.strip()
-            if "Language:" in text:
-                language = text.split("Language:")[-1].strip()
-                logger.info(f"Found language: {language}")
-            elif "Binding:" in text:
-                binding = text.split("Binding:")[-1].strip()
-                logger.info(f"Found binding: {binding}")
-
-        # If genre is still unknown, try to determine from book name and description
-        if genre == "Unknown":
-            genre = determine_genre(book_name, description)
-            logger.info(f"Determined genre from content: {genre}")
-
-        # Log the final data being returned
-        logger.info(f"Bookswagon scraping complete. Returning data for {book_name}")
-        return book_name, isbn, author, image_url, "bookswagon", price, rating, description, genre, binding, language
+                self.total_bytes += os.path.getsize(path) - old_size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _disk_usage(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith(".json.gz"))
+
+    def _evict(self):
+        # Drop least recently used entries until we are 10% under the cap
+        entries = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.name.endswith(".json.gz")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        target = self.max_bytes * 0.9
+        for entry in entries:
+            if self.total_bytes <= target:
+                break
+            size = entry.stat().st_size
+            if self._remove(entry.path):
+                self.total_bytes -= size
+        logger.info(f"HTTP cache evicted down to {self.total_bytes} bytes")
 
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+http_cache = HttpCache(HTTP_CACHE_DIR, HTTP_CACHE_MAX_BYTES, HTTP_CACHE_TTLS, DEFAULT_HTTP_CACHE_TTL)
+
+# Debug captures: pages the extractors could not make sense of, gzipped into
+# DEBUG_CAPTURE_DIR/<store>/ and evicted oldest first past the size cap
+DEBUG_CAPTURE_DIR = os.environ.get("DEBUG_CAPTURE_DIR", "debug_captures")
+DEBUG_CAPTURE_MAX_BYTES = 50 * 1024 * 1024
+# Share of misses captured, and the least seconds between two captures of a store
+DEBUG_CAPTURE_SAMPLE_RATE = float(os.environ.get("DEBUG_CAPTURE_SAMPLE_RATE", "1.0"))
+DEBUG_CAPTURE_MIN_INTERVAL = float(os.environ.get("DEBUG_CAPTURE_MIN_INTERVAL", "10"))
+# Captures waiting for the writer thread; more than this are dropped
+DEBUG_CAPTURE_QUEUE = 32
+
+class DebugCapture:
+    """Ring directory of compressed page snapshots, written off the request path.
+
+    capture() only samples and queues; a writer thread compresses the page,
+    writes it under <store>/<timestamp>-<url hash>.html.gz and evicts the
+    oldest snapshots once the directory outgrows its cap.
+    """
+
+    def __init__(self, directory, max_bytes, sample_rate, min_interval, queue_size=DEBUG_CAPTURE_QUEUE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.sample_rate = sample_rate
+        self.min_interval = min_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.last_capture = {}
+        self.total_bytes = None
+        self.writer = None
+        self._lock = threading.Lock()
+
+    def capture(self, website, url, html, reason):
+        """Queue a snapshot of a page, subject to sampling. Never blocks."""
+        now = time.monotonic()
+        with self._lock:
+            if random.random() >= self.sample_rate:
+                return False
+            if now - self.last_capture.get(website, float("-inf")) < self.min_interval:
+                return False
+            self.last_capture[website] = now
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_loop, name="debug-capture", daemon=True)
+                self.writer.start()
+        try:
+            self.queue.put_nowait((website, url, html, reason, time.time()))
+        except queue.Full:
+            scraper_metrics.incr(website, 'debug_captures_dropped')
+            return False
+        return True
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                logger.warning(f"Could not write debug capture: {e}")
+            finally:
+                self.queue.task_done()
+
+    def _write(self, website, url, html, reason, captured_at):
+        store_dir = os.path.join(self.directory, website)
+        os.makedirs(store_dir, exist_ok=True)
+        stamp = datetime.fromtimestamp(captured_at).strftime("%Y%m%d-%H%M%S-%f")
+        url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()[:12]
+        path = os.path.join(store_dir, f"{stamp}-{url_hash}.html.gz")
+        # The comment keeps the page's origin with it
+        header = f"<!-- url: {url} | reason: {reason} | captured: {datetime.fromtimestamp(captured_at).isoformat()} -->\n"
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            f.write(header + html)
+        size = os.path.getsize(path)
+        if self.total_bytes is None:
+            self.total_bytes = self._disk_usage()
+        else:
+            self.total_bytes += size
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+        scraper_metrics.incr(website, 'debug_captures')
+        logger.info(f"Saved {website} debug capture ({reason}) to {path}")
+
+    def _snapshots(self):
+        for store_dir in os.scandir(self.directory):
+            if store_dir.is_dir():
+                for entry in os.scandir(store_dir.path):
+                    if entry.name.endswith(".html.gz"):
+                        yield entry
+
+    def _disk_usage(self):
+        return sum(entry.stat().st_size for entry in self._snapshots())
+
+    def _evict(self):
+        # File names start with the capture time, so name order is age order
+        for entry in sorted(self._snapshots(), key=lambda entry: entry.name):
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+                self.total_bytes -= size
+            except OSError:
+                pass
+
+    def close(self, timeout=5):
+        """Let queued captures finish writing."""
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join(timeout)
+
+debug_capture = DebugCapture(DEBUG_CAPTURE_DIR, DEBUG_CAPTURE_MAX_BYTES, DEBUG_CAPTURE_SAMPLE_RATE, DEBUG_CAPTURE_MIN_INTERVAL)
+atexit.register(debug_capture.close)
+
+# Archive of fetched product pages, so rows can be re-extracted after an
+# extractor fix without scraping again. Set PAGE_ARCHIVE=0 to stop archiving
+PAGE_ARCHIVE = os.environ.get("PAGE_ARCHIVE", "1") == "1"
+PAGE_ARCHIVE_DIR = os.environ.get("PAGE_ARCHIVE_DIR", "page_archive")
+
+class PageArchive:
+    """Content-addressed store of gzipped pages.
+
+    Pages are stored once per distinct body, under <dir>/<hash[:2]>/<hash>.html.gz,
+    so a page fetched again unchanged costs no extra disk.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, content_hash):
+        return os.path.join(self.directory, content_hash[:2], content_hash + ".html.gz")
+
+    def put(self, html):
+        """Store a page body and return its content hash."""
+        content_hash = hashlib.sha256(html.encode("utf-8")).hexdigest()
+        path = self.path(content_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write aside and rename so readers never see a partial page
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                f.write(html)
+            os.replace(tmp_path, path)
+        return content_hash
+
+    def get(self, content_hash):
+        with gzip.open(self.path(content_hash), "rt", encoding="utf-8") as f:
+            return f.read()
+
+page_archive = PageArchive(PAGE_ARCHIVE_DIR)
+
+def archive_product_page(website, url, html, offer):
+    """Keep a fetched product page and record which offer it was scraped as."""
+    if not PAGE_ARCHIVE:
+        return
+    try:
+        content_hash = page_archive.put(html)
+        with orm.db_session:
+            ArchivedPage(website=website, url=url, content_hash=content_hash, book_name=offer[0],
+                         isbn=offer[1], fetched=datetime.now())
     except Exception as e:
-        logger.error(f"Error scraping Bookswagon: {e}")
-        return book_name, "Unknown", "Unknown", "https://source.unsplash.com/random/300x400/?book", "bookswagon", 0.0, 0.0, "No description available", "Unknown", "Unknown", "Unknown"
-
-def kitabay(session, headers, book_name):
-    # FIX: Improved Kitabay search to better match book titles
-    search_url = "https://kitabay.com/search?q=" + "+".join(book_name.split())
+        logger.warning(f"Could not archive {url}: {e}")
+
+# Connections kept per store, shared by every scrape in the process
+STORE_POOL_SIZE = int(os.environ.get("STORE_POOL_SIZE", "10"))
+# Seconds an idle store connection is kept open for reuse
+KEEPALIVE_TIMEOUT = 60
+# Seconds resolved store addresses are cached by the async client
+DNS_CACHE_TTL = 300
+
+# Circuit breaker per store: after BREAKER_FAILURE_THRESHOLD failures in a row
+# (errors, timeouts, block statuses or CAPTCHA pages) the store is skipped
+# without a request for BREAKER_OPEN_SECONDS. Then a single probe request is
+# let through; if it fails too the store stays open for twice as long
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_OPEN_SECONDS = int(os.environ.get("BREAKER_OPEN_SECONDS", "60"))
+BREAKER_MAX_OPEN_SECONDS = 15 * 60
+# Statuses stores answer with when they throttle or block us
+BLOCKED_STATUSES = {403, 429, 503}
+# CAPTCHA and bot-check pages are small, so only short pages are checked for these
+CAPTCHA_MARKERS = (
+    "/errors/validatecaptcha", "robot check", "enter the characters you see below",
+    "are you a human", "unusual traffic", "cf-chl-", "captcha-delivery",
+)
+CAPTCHA_PAGE_MAX_CHARS = 50000
+
+class StoreUnavailable(Exception):
+    """Raised instead of fetching while a store's circuit is open."""
+
+class StoreBlocked(Exception):
+    """Raised when a store answers with an error, block or CAPTCHA page."""
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+def retry_after_seconds(value):
+    """Seconds from a Retry-After header (delta or HTTP date), or None."""
+    if not value:
+        return None
     try:
-        logger.info(f"Searching Kitabay for: {book_name}")
-        resp = session.get(search_url, headers=headers, timeout=10)
-        logger.info(f"Kitabay response status: {resp.status_code}")
-        
-        soup = BeautifulSoup(resp.text, "html.parser")
-        
-        # FIX: Improved book link detection to find relevant books
-        book_links = []
-        
-        # Find all potential book links
-        for link in soup.select("a"):
-            href = link.get('href', '')
-            if '/products/' in href:
-                # Check if the link text or parent text contains parts of the book name
-                link_text = link.text.strip().lower()
-                parent_text = link.parent.text.strip().lower() if link.parent else ""
-                book_name_parts = [part.lower() for part in book_name.split() if len(part) > 2]
-                
-                # Check if any significant part of the book name is in the link text
-                matches = sum(1 for part in book_name_parts if part in link_text or part in parent_text)
-                if matches > 0:
-                    book_links.append((link, matches))
-        
-        # Sort by number of matches (highest first)
-        book_links.sort(key=lambda x: x[1], reverse=True)
-        
-        # Use the link with the most matches
-        book_link = book_links[0][0] if book_links else None
-            
-        if not book_link:
-            logger.warning("No relevant book link found on Kitabay")
-            # Save the HTML for debugging
-            with open("kitabay_debug.html", "w", encoding="utf-8") as f:
-                f.write(resp.text)
-            logger.info("Saved Kitabay HTML for debugging")
-            return book_name, "Unknown", "Unknown", "https://source.unsplash.com/random/300x400/?book", "kitabay", 0.0, 0.0, "No description available", "Unknown", "Unknown", "Unknown"
-
-        # Get the book page URL
-        book_url = book_link['href']
-        if not book_url.startswith("https://"):
-            book_url = "https://kitabay.com" + book_url
-        logger.info(f"Found book on Kitabay: {book_url}")
-        
-        # Add a delay to avoid being blocked
-        time.sleep(2)
-        
-        # Get the book page
-        resp = session.get(book_url, headers=headers, timeout=10)
-        logger.info(f"Kitabay book page status: {resp.status_code}")
-        
-        soup = BeautifulSoup(resp.text, "html.parser")
-
-        # Extract book title
-        title_element = soup.select_one("h1")
-        book_name = title_element.text.strip() if title_element else book_name
-        logger.info(f"Extracted title: {book_name}")
-
-        # Try multiple price selectors
-        price = 0.0
-        price_selectors = [
-            "p.product__inline__price > span.price.on-sale",
-            "p.product__inline__price > span.price",
-            "div.product__price span.price",
-            ".product-price",
-            ".price-item",
-            ".price--highlight",  # Add more selectors
-            ".price-item--regular",
-            "[data-price]"
-        ]
-        
-        for selector in price_selectors:
-            price_elements = soup.select(selector)
-            for price_element in price_elements:
-                if price_element:
-                    # Try to get price from data attribute first
-                    if price_element.has_attr('data-price'):
-                        try:
-                            price = float(price_element['data-price']) / 100  # Convert cents to rupees
-                            logger.info(f"Extracted price: {price} from data-price attribute")
-                            break
-                        except (ValueError, TypeError):
-                            pass
-                    
-                    # Try to extract from text
-                    price_text = price_element.text.strip()
-                    price = extract_price(price_text)
-                    if price > 0:
-                        logger.info(f"Extracted price: {price} using selector {selector}")
-                        break
-            if price > 0:
-                break
-        
-        # Try direct text search for price if selectors fail
-        if price == 0.0:
-            logger.info("Trying direct text search for price")
-            price_patterns = [
-                r'₹\s*([\d,]+\.?\d{0,2})',
-                r'Rs\.?\s*([\d,]+\.?\d{0,2})'
-            ]
-            
-            for pattern in price_patterns:
-                matches = re.findall(pattern, soup.text)
-                if matches:
-                    try:
-                        price_str = matches[0]
-                        if isinstance(price_str, tuple):
-                            price_str = price_str[0]
-                        price = float(price_str.replace(',', ''))
-                        logger.info(f"Found price {price} using direct text search")
-                        break
-                    except (ValueError, IndexError) as e:
-                        logger.warning(f"Error parsing price from direct text: {e}")
-                        continue
-
-        # Extract author - improved author extraction
-        author_element = soup.select_one("div.product__inline__author, .author-name, .product-meta__vendor")
-        author = "Unknown"
-        if author_element:
-            author_text = author_element.text.strip()
-            # Clean up author text
-            if "by" in author_text.lower():
-                author = author_text.split("by", 1)[1].strip()
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def blocked_reason(status, text):
+    """Why a response counts against the store's breaker, or None if it does not."""
+    if status in BLOCKED_STATUSES or status >= 500:
+        return f"HTTP {status}"
+    if len(text) <= CAPTCHA_PAGE_MAX_CHARS:
+        lowered = text.lower()
+        for marker in CAPTCHA_MARKERS:
+            if marker in lowered:
+                return f"CAPTCHA page ({marker})"
+    return None
+
+class CircuitBreaker:
+    """Closed, open or half-open state of one store.
+
+    Updated on the engine loop and read by the request handlers, so state
+    changes are made under a lock.
+    """
+
+    def __init__(self, website, threshold=BREAKER_FAILURE_THRESHOLD, open_seconds=BREAKER_OPEN_SECONDS):
+        self.website = website
+        self.threshold = threshold
+        self.base_open_seconds = open_seconds
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.open_for = 0.0
+        self.probe_started = None
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a request may go out now; claims the probe when half-open."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "closed":
+                return True
+            if self.state == "open" and now - self.opened_at >= self.open_for:
+                self.state = "half_open"
+                self.probe_started = None
+            if self.state == "half_open":
+                # One probe at a time; a probe that never reported back is given up on
+                if self.probe_started is None or now - self.probe_started > 2 * FETCH_TIMEOUT:
+                    self.probe_started = now
+                    logger.info(f"Circuit half-open for {self.website}, sending probe")
+                    return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info(f"Circuit closed for {self.website}")
+            self.state = "closed"
+            self.failures = 0
+            self.open_seconds = self.base_open_seconds
+            self.probe_started = None
+
+    def record_failure(self, reason, retry_after=None):
+        with self._lock:
+            self.failures += 1
+            self.last_error = reason
+            if self.state == "half_open":
+                # The probe failed: back off harder before the next one
+                self.open_seconds = min(self.open_seconds * 2, BREAKER_MAX_OPEN_SECONDS)
+            elif self.failures < self.threshold and retry_after is None:
+                return
+            # A store asking us to come back later sets how long we stay away;
+            # the retry that honours it then goes out as the half-open probe
+            if retry_after is not None:
+                self.open_for = min(retry_after, BREAKER_MAX_OPEN_SECONDS)
             else:
-                author = author_text
-            logger.info(f"Extracted author: {author}")
-
-        # Extract ISBN - IMPROVED FROM webscrape2.py
-        isbn = "Unknown"
-        # First try to find a paragraph that specifically contains ISBN
-        isbn_element = soup.find("p", string=re.compile("ISBN:"))
-        if isbn_element:
-            isbn_text = isbn_element.text.strip()
-            isbn_match = re.search(r'ISBN:\s*(\d{3}-?\d{10}|\d{10})', isbn_text)
-            if isbn_match:
-                isbn = isbn_match.group(1).replace("-", "")
-                logger.info(f"Found ISBN in dedicated paragraph: {isbn}")
-        
-        # If ISBN is still unknown, try to find it in the product description
-        if isbn == "Unknown":
-            details = soup.select_one("div.product__description, .product-details")
-            if details:
-                isbn_match = re.search(r'ISBN-13\D*(\d{3}-?\d{10}|\d{10})', details.text)
-                if not isbn_match:
-                    isbn_match = re.search(r'ISBN\D*(\d{3}-?\d{10}|\d{10})', details.text)
-                isbn = isbn_match.group(1).replace("-", "") if isbn_match else "Unknown"
-                logger.info(f"Found ISBN in product description: {isbn}")
-        
-        # If ISBN is still unknown, try to find it in any text on the page
-        if isbn == "Unknown":
-            isbn_match = re.search(r'ISBN-13\D*(\d{3}-?\d{10}|\d{10})', soup.text)
-            if not isbn_match:
-                isbn_match = re.search(r'ISBN\D*(\d{3}-?\d{10}|\d{10})', soup.text)
-            isbn = isbn_match.group(1).replace("-", "") if isbn_match else "Unknown"
-            if isbn != "Unknown":
-                logger.info(f"Found ISBN in page text: {isbn}")
-        
-        # Clean up the ISBN
-        if isbn != "Unknown":
-            # Remove any non-digit characters
-            isbn = re.sub(r'[^0-9]', '', isbn)
-            # Ensure it's a valid ISBN length (10 or 13 digits)
-            if len(isbn) not in [10, 13]:
-                isbn = "Unknown"
-        
-        logger.info(f"Extracted ISBN: {isbn}")
-
-        # Kitabay doesn't consistently provide ratings
-        rating = 0.0
-
-        # Extract description
-        description_element = soup.select_one("div.product__description, .product-description")
-        description = description_element.text.strip() if description_element else "No description available"
-        logger.info(f"Extracted description: {description[:50]}...")
-
-        # Extract image URL
-        image_element = soup.select_one("div.product__image img, .product-featured-img, .product-single__media img")
-        image_url = "https://source.unsplash.com/random/300x400/?book"
-        if image_element:
-            if 'src' in image_element.attrs:
-                image_url = image_element['src']
-            elif 'data-src' in image_element.attrs:
-                image_url = image_element['data-src']
-                
-        if image_url and not image_url.startswith("http"):
-            image_url = "https:" + image_url
-        logger.info(f"Extracted image URL: {image_url}")
-
-        # Try to extract genre, binding, and language from description
-        genre = "Unknown"
-        binding = "Unknown"
-        language = "Unknown"
-        
-        if description_element:
-            desc_text = description_element.text.lower()
-            
-            # Extract genre 
-            desc_text = description_element.text.lower()
-            
-            # Extract genre
-            genre_keywords = {
-                "fiction": "Fiction",
-                "non-fiction": "Non-Fiction",
-                "biography": "Biography",
-                "autobiography": "Autobiography",
-                "mystery": "Mystery",
-                "thriller": "Thriller",
-                "romance": "Romance",
-                "science fiction": "Science Fiction",
-                "fantasy": "Fantasy",
-                "horror": "Horror",
-                "children": "Children's Books",
-                "young adult": "Young Adult",
-                "self-help": "Self-Help",
-                "business": "Business",
-                "history": "History"
+                self.open_for = self.open_seconds
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.probe_started = None
+        scraper_metrics.incr(self.website, 'breaker_opened')
+        logger.warning(f"Circuit open for {self.website} for {self.open_for:.0f}s after: {reason}")
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'breaker_state': self.state,
+                'breaker_failures': self.failures,
+                'breaker_last_error': self.last_error,
             }
-            
-            for keyword, genre_name in genre_keywords.items():
-                if keyword in desc_text:
-                    genre = genre_name
-                    logger.info(f"Found genre from description: {genre}")
-                    break
-            
-            # Extract binding and language if mentioned in description
-            if "hardcover" in desc_text:
-                binding = "Hardcover"
-                logger.info(f"Found binding from description: {binding}")
-            elif "paperback" in desc_text:
-                binding = "Paperback"
-                logger.info(f"Found binding from description: {binding}")
-            elif "ebook" in desc_text or "e-book" in desc_text:
-                binding = "E-Book"
-                logger.info(f"Found binding from description: {binding}")
-            
-            language_patterns = [
-                r'language:\s*(\w+)',
-                r'in\s+(\w+)\s+language',
-                r'written in\s+(\w+)'
-            ]
-            
-            for pattern in language_patterns:
-                language_match = re.search(pattern, desc_text)
-                if language_match:
-                    language = language_match.group(1).capitalize()
-                    logger.info(f"Found language from description: {language}")
-                    break
 
-        # If genre is still unknown, try to determine from book name and description
-        if genre == "Unknown":
-            genre = determine_genre(book_name, description)
-            logger.info(f"Determined genre from content: {genre}")
+class StoreBreakers:
+    """One circuit breaker per store, created on first use."""
+
+    def __init__(self):
+        self.breakers = {}
+        self._lock = threading.Lock()
+
+    def breaker_for(self, website):
+        with self._lock:
+            if website not in self.breakers:
+                self.breakers[website] = CircuitBreaker(website)
+            return self.breakers[website]
+
+    def snapshot(self):
+        with self._lock:
+            breakers = list(self.breakers.items())
+        return {website: breaker.snapshot() for website, breaker in breakers}
+
+store_breakers = StoreBreakers()
+
+def open_circuit_check(website):
+    """Fail fast when the store's circuit is open."""
+    breaker = store_breakers.breaker_for(website)
+    if not breaker.allow():
+        scraper_metrics.incr(website, 'breaker_rejected')
+        raise StoreUnavailable(f"circuit open for {website}")
+    return breaker
+
+def check_response(breaker, status, text, response_headers):
+    """Report a response to the store's breaker, raising StoreBlocked for a block page."""
+    reason = blocked_reason(status, text)
+    if reason is None:
+        breaker.record_success()
+        return
+    retry_after = retry_after_seconds(response_headers.get("Retry-After")) if status in (429, 503) else None
+    scraper_metrics.incr(breaker.website, 'blocked')
+    breaker.record_failure(reason, retry_after)
+    raise StoreBlocked(f"{breaker.website} answered with {reason}", status, retry_after)
+
+# Retries: a failed fetch is retried up to "attempts" times in total, after
+# a random wait of up to backoff * 2^n seconds (full jitter) capped at
+# max_backoff, or the store's Retry-After if that is longer. Stores can
+# override the policy with a "retry" entry in their config
+DEFAULT_RETRY_POLICY = {"attempts": 3, "backoff": 0.5, "max_backoff": 8.0}
+# Statuses worth retrying; block pages such as 403 and CAPTCHAs are not
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Give up rather than wait when a store asks us back later than this, in seconds
+RETRY_AFTER_LIMIT = 30
+
+def retry_policy(website):
+    return dict(DEFAULT_RETRY_POLICY, **STORE_REGISTRY.get(website, {}).get("retry", {}))
+
+def is_retryable(error):
+    if isinstance(error, StoreBlocked):
+        return error.status in RETRYABLE_STATUSES
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+def retry_delay(website, url, attempt, error, deadline=None):
+    """Seconds to wait before retrying a failed fetch, or None to give up.
+
+    attempt is the number of the attempt that just failed, counting from 1.
+    """
+    policy = retry_policy(website)
+    if attempt >= policy["attempts"] or not is_retryable(error):
+        return None
+    delay = random.uniform(0, min(policy["max_backoff"], policy["backoff"] * 2 ** (attempt - 1)))
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        if retry_after > RETRY_AFTER_LIMIT:
+            return None
+        delay = max(delay, retry_after)
+    # No point starting a retry the caller will no longer wait for
+    if deadline is not None and time.monotonic() + delay > deadline:
+        return None
+    logger.info(f"Retrying {url} in {delay:.2f}s (attempt {attempt + 1} of {policy['attempts']}) after: {error}")
+    scraper_metrics.incr(website, 'retries')
+    return delay
+
+def placeholder_data(book_name, website="amazon"):
+    """Placeholder row used when a store returns nothing usable."""
+    return (
+        book_name, "Unknown", "Unknown",
+        "https://source.unsplash.com/random/300x400/?book",
+        website, 0.0, 0.0,
+        "No description available", "Unknown",
+        "Unknown", "Unknown"
+    )
+
+class NoAnswer(tuple):
+    """Placeholder offer for a store that did not answer.
+
+    Either its scrape failed or, with skipped set, it was skipped because
+    its circuit is open. A plain placeholder means the store answered but
+    had nothing usable.
+    """
+
+    def __new__(cls, book_name, website, skipped=False):
+        offer = super().__new__(cls, placeholder_data(book_name, website))
+        offer.skipped = skipped
+        return offer
+
+def answered(offers):
+    """Whether a store's scrape result came from the store answering."""
+    return not any(isinstance(offer, NoAnswer) for offer in offers)
+
+class ScrapeEngine:
+    """Runs store scrapes on one asyncio event loop in a background thread.
+
+    Flask handlers are synchronous, so they hand coroutines to the engine with
+    run() and block only on the result. Every in-flight lookup shares the same
+    loop and HTTP client instead of holding an OS thread per request.
+    """
+
+    def __init__(self, max_concurrent_fetches=MAX_CONCURRENT_FETCHES):
+        self.loop = None
+        # One pooled HTTP client per store, shared by every lookup
+        self.clients = {}
+        self.fetch_slots = asyncio.Semaphore(max_concurrent_fetches)
+        self.ssl_context = ssl.create_default_context()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self.loop.run_forever, name="scrape-engine", daemon=True)
+                thread.start()
+                logger.info("Scrape engine event loop started")
+        return self.loop
+
+    def submit(self, coro):
+        """Schedule a coroutine on the engine loop and return a concurrent Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.start())
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the engine loop and wait for its result."""
+        return self.submit(coro).result(timeout)
+
+    def connection_trace(self, website):
+        """aiohttp trace hooks counting new and reused connections for a store."""
+        async def on_created(session, context, params):
+            scraper_metrics.incr(website, 'connections_opened')
+
+        async def on_reused(session, context, params):
+            scraper_metrics.incr(website, 'connections_reused')
+
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(on_created)
+        trace.on_connection_reuseconn.append(on_reused)
+        return trace
+
+    async def get_client(self, website):
+        # Only ever called on the engine loop, so no locking is needed
+        client = self.clients.get(website)
+        if client is None or client.closed:
+            # Keep-alive connections are reused across lookups, so the DNS
+            # lookup and TLS handshake are paid once per connection, not per
+            # request; the SSL context (and its CA bundle) is shared too
+            connector = aiohttp.TCPConnector(
+                limit=STORE_POOL_SIZE,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=DNS_CACHE_TTL,
+                ssl=self.ssl_context,
+            )
+            client = aiohttp.ClientSession(
+                connector=connector,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT),
+                trace_configs=[self.connection_trace(website)],
+            )
+            self.clients[website] = client
+        return client
 
-        # Log the final data being returned
-        logger.info(f"Kitabay scraping complete. Returning data for {book_name}")
-        return book_name, isbn, author, image_url, "kitabay", price, rating, description, genre, binding, language
+    async def _close_clients(self):
+        for client in self.clients.values():
+            if not client.closed:
+                await client.close()
 
-    except Exception as e:
-        logger.error(f"Error scraping Kitabay: {e}")
-        return book_name, "Unknown", "Unknown", "https://source.unsplash.com/random/300x400/?book", "kitabay", 0.0, 0.0, "No description available", "Unknown", "Unknown", "Unknown"
+    def close(self):
+        """Close the pooled HTTP clients, e.g. at interpreter exit."""
+        if self.loop is not None and self.loop.is_running():
+            try:
+                self.run(self._close_clients(), timeout=5)
+            except Exception as e:
+                logger.warning(f"Error closing scrape engine clients: {e}")
 
-def scrape_book(book_name):
-    session = requests.Session()
-    data = []
+scrape_engine = ScrapeEngine()
+atexit.register(scrape_engine.close)
+
+async def request_async(client, url, website, request_headers, timeout):
+    """Send one GET on the engine loop and return (status, text, headers)."""
+    async with scrape_engine.fetch_slots:
+        start = time.monotonic()
+        try:
+            async with client.get(url, headers=request_headers, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                scraper_metrics.incr(website, 'requests')
+                text = await resp.text()
+        except asyncio.TimeoutError:
+            store_latency.record(website, timeout)
+            raise
+        store_latency.record(website, time.monotonic() - start)
+        return resp.status, text, resp.headers
+
+async def hedged_request_async(client, url, website, request_headers, timeout):
+    """request_async, plus a second copy once the first outlives the store's p95.
+
+    The hedge needs a rate limit token that is free right now, so hedging
+    never makes a request wait on the host's budget. The first successful
+    response wins and the other request is cancelled.
+    """
+    first = asyncio.ensure_future(request_async(client, url, website, request_headers, timeout))
+    hedge_after = store_latency.hedge_delay(website)
+    if hedge_after is None or hedge_after >= timeout:
+        return await first
+
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done and await rate_limiter.try_acquire_async(url):
+            logger.info(f"Hedging slow request to {url} after {hedge_after:.2f}s")
+            scraper_metrics.incr(website, 'hedged')
+            tasks.append(asyncio.ensure_future(request_async(client, url, website, request_headers, timeout)))
+
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not first:
+                        scraper_metrics.incr(website, 'hedge_won')
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def fetch_text_async(client, url, deadline=None):
+    """Fetch a page through the HTTP cache on the engine loop and return (status, text).
+
+    A time.monotonic() deadline caps the request timeout. Transient failures
+    are retried under the store's retry policy.
+    """
+    # Cache files are read and written off the event loop
+    website = store_for_url(url)
+    cached = await asyncio.to_thread(http_cache.lookup, url)
+    if cached and http_cache.is_fresh(cached):
+        logger.info(f"HTTP cache hit: {url}")
+        scraper_metrics.incr(website, 'cache_hits')
+        return 200, cached["body"]
     
+    attempt = 1
+    while True:
+        try:
+            return await fetch_once_async(client, url, website, cached, deadline)
+        except (aiohttp.ClientError, asyncio.TimeoutError, StoreBlocked) as e:
+            delay = retry_delay(website, url, attempt, e, deadline)
+            if delay is None:
+                raise
+        await asyncio.sleep(delay)
+        attempt += 1
+
+async def fetch_once_async(client, url, website, cached, deadline):
+    """One attempt at a store request on the engine loop, spending one rate limit token."""
+    # An open circuit fails before spending a rate limit token
+    breaker = open_circuit_check(website)
+    # Wait for the host's budget before taking a fetch slot
+    await rate_limiter.acquire_async(url)
     try:
-        # Scrape from all sources
-        amazon_data = amazon(session, headers, book_name)
-        logger.info(f"Amazon data: {amazon_data[0]}, price: {amazon_data[5]}")
-        
-        # Add a delay between requests to avoid being blocked
-        time.sleep(2)
-        
-        bookswagon_data = bookswagon(session, headers, book_name)
-        logger.info(f"Bookswagon data: {bookswagon_data[0]}, price: {bookswagon_data[5]}")
-        
-        time.sleep(2)
-        
-        kitabay_data = kitabay(session, headers, book_name)
-        logger.info(f"Kitabay data: {kitabay_data[0]}, price: {kitabay_data[5]}")
-        
-        # Only add sources that returned valid data
-        if amazon_data[5] > 0:
-            data.append(amazon_data)
-        if bookswagon_data[5] > 0:
-            data.append(bookswagon_data)
-        if kitabay_data[5] > 0:
-            data.append(kitabay_data)
-        
-        # If we have no price data but have book details, add the sources with price 0
-        if not data:
-            if amazon_data[0] != "Unknown" and amazon_data[0] != book_name:
-                data.append(amazon_data)
-            if bookswagon_data[0] != "Unknown" and bookswagon_data[0] != book_name:
-                data.append(bookswagon_data)
-            if kitabay_data[0] != "Unknown" and kitabay_data[0] != book_name:
-                data.append(kitabay_data)
-            
-            # If still no data, add a placeholder
-            if not data:
-                data.append((
-                    book_name, "Unknown", "Unknown", 
-                    "https://source.unsplash.com/random/300x400/?book",
-                    "amazon", 0.0, 0.0, 
-                    "No description available", "Unknown",
-                    "Unknown", "Unknown"
-                ))
+        status, text, response_headers = await hedged_request_async(
+            client, url, website, http_cache.conditional_headers(cached), fetch_timeout(deadline, website))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        breaker.record_failure(f"{type(e).__name__}: {e}")
+        raise
+    if status == 304 and cached:
+        logger.info(f"HTTP cache revalidated: {url}")
+        scraper_metrics.incr(website, 'cache_revalidated')
+        breaker.record_success()
+        entry = await asyncio.to_thread(http_cache.revalidated, cached, response_headers)
+        return 200, entry["body"]
+    check_response(breaker, status, text, response_headers)
+    if status == 200:
+        await asyncio.to_thread(http_cache.store, url, text, response_headers)
+    return status, text
+
+async def scrape_store_async(website, client, book_name, deadline=None, price_only=False, fetch_product=False):
+    """Scrape one store on the engine loop, returning its offers best match first.
+
+    With price_only, a search result card with a price is enough and the
+    product page is only fetched when the card has none. With fetch_product,
+    the top result's product page is fetched even when its card is complete.
+    """
+    label = STORE_REGISTRY[website]["label"]
+    try:
+        logger.info(f"Searching {label} for: {book_name}")
+        status, html = await fetch_text_async(client, store_search_url(website, book_name), deadline)
+        logger.info(f"{label} response status: {status}")
+        if status >= 500:
+            logger.error(f"{label} search failed with status {status}")
+            return [NoAnswer(book_name, website)]
+        
+        # Parsing is CPU bound; keep it off the event loop the fetches share
+        offers, book_url = await asyncio.to_thread(search_page_offers, website, html, book_name,
+                                                   PRICE_ONLY_FIELDS if price_only else None, fetch_product)
+        if book_url:
+            offers.insert(0, (await fetch_product_offer(website, client, book_url, book_name, deadline))[1])
+        return offers or [placeholder_data(book_name, website)]
+    except StoreUnavailable as e:
+        logger.info(f"Skipping {label}: {e}")
+        return [NoAnswer(book_name, website, skipped=True)]
     except Exception as e:
-        logger.error(f"Error in scrape_book: {e}")
-        # Add a placeholder if there's an error
-        data.append((
-            book_name, "Unknown", "Unknown", 
-            "https://source.unsplash.com/random/300x400/?book",
-            "amazon", 0.0, 0.0, 
-            "No description available", "Unknown",
-            "Unknown", "Unknown"
-        ))
+        logger.error(f"Error scraping {label}: {e}")
+        return [NoAnswer(book_name, website)]
+
+async def fetch_product_offer(website, client, url, book_name, deadline=None):
+    """Fetch and extract a product page; returns (status, offer).
+
+    A page that loaded and yielded a priced offer is archived, and its URL
+    remembered under the ISBN it carries. Error pages and pages the
+    extractor got nothing from are not archived, so re-extraction never
+    applies them to the rows of the book they were fetched for.
+    """
+    status, html = await fetch_text_async(client, url, deadline)
+    logger.info(f"{STORE_REGISTRY[website]['label']} book page status: {status}")
+    product = await asyncio.to_thread(parse_product, website, html, book_name)
+    if product[5] <= 0:
+        debug_capture.capture(website, url, html, "no price on product page")
+    if status == 200 and product[5] > 0:
+        await asyncio.to_thread(archive_product_page, website, url, html, product)
+        if product[1] not in MISSING_VALUES:
+            await asyncio.to_thread(remember_product_url, website, product[1], url)
+    return status, product
+
+def cached_product_url(website, isbn):
+    with orm.db_session:
+        entry = ProductUrl.get(website=website, isbn=isbn)
+        return entry.url if entry else None
+
+def remember_product_url(website, isbn, url):
+    with orm.db_session:
+        entry = ProductUrl.get(website=website, isbn=isbn)
+        if entry:
+            entry.set(url=url, found=datetime.now())
+        else:
+            ProductUrl(website=website, isbn=isbn, url=url, found=datetime.now())
+
+def forget_product_url(website, isbn):
+    with orm.db_session:
+        orm.delete(p for p in ProductUrl if p.website == website and p.isbn == isbn)
+
+async def scrape_store_by_isbn_async(website, client, isbn, book_name, deadline=None, price_only=False):
+    """Look a known ISBN up at one store without a title search.
+
+    Tries the product URL remembered for the ISBN, then the URL the store
+    builds from an ISBN, then a search for the ISBN itself, and falls back
+    to the title search only when none of them finds the book. Unless
+    price_only, the offer comes from a product page, so its metadata counts
+    as fetched. Returns the store's offers best match first, like
+    scrape_store_async.
+    """
+    label = STORE_REGISTRY[website]["label"]
+    try:
+        cached = await asyncio.to_thread(cached_product_url, website, isbn)
+        for url in dict.fromkeys(url for url in (cached, isbn_product_url(website, isbn)) if url):
+            status, offer = await fetch_product_offer(website, client, url, book_name, deadline)
+            # A page with no ISBN of its own is trusted only at a URL found for this ISBN before
+            if status == 200 and offer[5] > 0 and (offer[1] == isbn or (url == cached and offer[1] in MISSING_VALUES)):
+                logger.info(f"Found ISBN {isbn} on {label} at {url}")
+                return [offer]
+            if url == cached:
+                logger.info(f"Remembered {label} URL for ISBN {isbn} no longer has the book, forgetting it")
+                await asyncio.to_thread(forget_product_url, website, isbn)
+
+        logger.info(f"Searching {label} for ISBN: {isbn}")
+        status, html = await fetch_text_async(client, store_search_url(website, isbn), deadline)
+        offers, book_url = await asyncio.to_thread(search_page_offers, website, html, book_name,
+                                                   PRICE_ONLY_FIELDS if price_only else None, not price_only)
+        if book_url:
+            offers.insert(0, (await fetch_product_offer(website, client, book_url, book_name, deadline))[1])
+        # Results of an ISBN search without ISBNs of their own are taken to be the book
+        if any(offer[1] == isbn and offer[5] > 0 for offer in offers) or \
+                (offers and offers[0][5] > 0 and offers[0][1] in MISSING_VALUES):
+            return offers
+    except StoreUnavailable as e:
+        logger.info(f"Skipping {label}: {e}")
+        return [NoAnswer(book_name, website, skipped=True)]
+    except Exception as e:
+        logger.error(f"Error looking up ISBN {isbn} on {label}: {e}")
+    logger.info(f"ISBN {isbn} not found directly on {label}, searching by title")
+    return await scrape_store_async(website, client, book_name, deadline, price_only, not price_only)
+
+def select_offers(book_name, results, placeholder=True):
+    """Choose which store offers to keep from a {website: [offers]} mapping."""
+    data = []
+    
+    # Only add offers that returned valid data
+    for website, items in results.items():
+        for item in items:
+            logger.info(f"{website.capitalize()} data: {item[0]}, price: {item[5]}")
+            if item[5] > 0:
+                data.append(item)
+    
+    # If we have no price data but have book details, add the store's best match with price 0
+    if not data:
+        for items in results.values():
+            item = items[0]
+            if item[0] != "Unknown" and item[0] != book_name:
+                data.append(item)
+        
+        # If still no data, add a placeholder
+        if not data and placeholder:
+            data.append(placeholder_data(book_name))
     
     # Print summary of scraping results
     logger.info("\nScraping Summary:")
-    logger.info(f"Amazon: {'Success' if amazon_data[5] > 0 else 'No price found'}")
-    logger.info(f"Bookswagon: {'Success' if bookswagon_data[5] > 0 else 'No price found'}")
-    logger.info(f"Kitabay: {'Success' if kitabay_data[5] > 0 else 'No price found'}")
+    for website, items in results.items():
+        priced = sum(1 for item in items if item[5] > 0)
+        logger.info(f"{website.capitalize()}: {f'{priced} priced offers' if priced else 'No price found'}")
     
     return data
 
+# Background saves of offers from stores that missed a deadline
+late_saves = set()
+
+async def save_late_offers(book_name, tasks, price_only=()):
+    """Wait for stores that missed the deadline and save their priced offers."""
+    offers = []
+    for items in await asyncio.gather(*tasks):
+        offers.extend(item for item in items if item[5] > 0)
+    if offers:
+        await asyncio.to_thread(save_book_data, offers, price_only)
+    logger.info(f"Saved {len(offers)} late offers for '{book_name}'")
+
+async def scrape_stores_async(book_name, deadline=None, stores=None, price_only=(), isbn=None):
+    """Scrape the registered stores (or just the named ones) concurrently on the engine loop.
+
+    Stores listed in price_only are scraped for prices alone (see
+    scrape_store_async). With an ISBN, stores look it up directly (see
+    scrape_store_by_isbn_async) instead of searching by title. Waits for
+    every store, or until a time.monotonic() deadline.
+
+    Returns ({website: offers} for the stores that finished, tasks still running).
+    """
+    tasks = {}
+    for website in stores or STORE_REGISTRY:
+        client = await scrape_engine.get_client(website)
+        if isbn:
+            scrape = scrape_store_by_isbn_async(website, client, isbn, book_name, deadline, website in price_only)
+        else:
+            scrape = scrape_store_async(website, client, book_name, deadline, website in price_only)
+        tasks[website] = asyncio.ensure_future(scrape)
+
+    if deadline is None:
+        await asyncio.gather(*tasks.values())
+    else:
+        await asyncio.wait(tasks.values(), timeout=max(0, deadline - time.monotonic()))
+
+    results = {website: task.result() for website, task in tasks.items() if task.done()}
+    return results, [task for task in tasks.values() if not task.done()]
+
+async def scrape_book_async(book_name, deadline=None, stores=None, price_only=(), isbn=None):
+    """Scrape the stores as scrape_stores_async does and choose the offers to keep.
+
+    With a deadline, returns the offers that arrived in time; stores still
+    running keep going in the background and their offers are saved when
+    they land.
+    """
+    results, late = await scrape_stores_async(book_name, deadline, stores, price_only, isbn)
+    if late:
+        logger.info(f"Deadline reached for '{book_name}' with {len(late)} stores still running")
+        save = asyncio.ensure_future(save_late_offers(book_name, late, price_only))
+        late_saves.add(save)
+        save.add_done_callback(late_saves.discard)
+    # Late stores may still find the book, so do not stand in a placeholder for them
+    return select_offers(book_name, results, placeholder=not late)
+
+# Freshness policy. An offer's fields are fetched in groups, each going
+# stale after its own TTL: prices move daily, the rest of an offer
+# (metadata) hardly ever. Stores override the TTLs with a "freshness" entry
+FIELD_GROUPS = {
+    "price": ("price",),
+    "metadata": ("book_name", "author", "image_url", "rating", "description", "genre", "binding", "language"),
+}
+DEFAULT_FRESHNESS = {"price": 24 * 3600, "metadata": 30 * 24 * 3600}
+
+# Values a scraper reports when it could not read a field; never written
+# over a known value when a row is updated in place
+MISSING_VALUES = (None, "", "Unknown", "No description available")
+
+def freshness_ttl(website, group):
+    """How long a store's field group stays fresh."""
+    policy = dict(DEFAULT_FRESHNESS, **STORE_REGISTRY.get(website, {}).get("freshness", {}))
+    return timedelta(seconds=policy[group])
+
+def stamp_checked(isbn, website, groups=tuple(FIELD_GROUPS), now=None):
+    """Mark field groups of a store's offer for an ISBN as fetched now. Call inside a db_session."""
+    now = now or datetime.now()
+    entry = OfferFreshness.get(isbn=isbn, website=website) or OfferFreshness(isbn=isbn, website=website)
+    entry.set(**{f"{group}_checked": now for group in groups})
+
+def record_checked(offers, groups=tuple(FIELD_GROUPS), now=None):
+    """Mark field groups of offers as fetched now. Call inside a db_session.
+
+    Offers read from a search result card only have their price marked.
+    Rows saved along with the stamp get the same now as their date, so a
+    later stamp shows the field was fetched again since (see refreshed_groups).
+    """
+    for item in offers:
+        if item[1] not in MISSING_VALUES:
+            stamp_checked(item[1], item[4], ("price",) if isinstance(item, CardOffer) else groups, now)
+
+def refreshed_groups(row):
+    """Field groups of a BookPrice row fetched again since the row was saved. Call inside a db_session."""
+    entry = OfferFreshness.get(isbn=row.isbn, website=row.website) if row.isbn not in MISSING_VALUES else None
+    if entry is None:
+        return set()
+    return {group for group in FIELD_GROUPS if (getattr(entry, f"{group}_checked") or datetime.min) > row.date_created}
+
+def last_checked(rows):
+    """When each field group of the offers behind BookPrice rows was last fetched.
+
+    Returns {(isbn, website): {group: datetime}}. Offers without a freshness
+    record (saved before there was one) count as fetched when their newest
+    row was saved. Call inside a db_session.
+    """
+    checked = {}
+    for row in rows:
+        dates = checked.setdefault((row.isbn, row.website), dict.fromkeys(FIELD_GROUPS, datetime.min))
+        for group in FIELD_GROUPS:
+            dates[group] = max(dates[group], row.date_created)
+    isbns = list({isbn for isbn, _ in checked if isbn not in MISSING_VALUES})
+    for entry in orm.select(f for f in OfferFreshness if f.isbn in isbns):
+        if (entry.isbn, entry.website) in checked:
+            checked[(entry.isbn, entry.website)] = {
+                group: getattr(entry, f"{group}_checked") or datetime.min for group in FIELD_GROUPS
+            }
+    return checked
+
+def stale_groups(checked, groups=tuple(FIELD_GROUPS)):
+    """{(isbn, website): [groups]} for the offers with field groups past their store's TTL."""
+    now = datetime.now()
+    stale = {}
+    for (isbn, website), dates in checked.items():
+        offer_groups = [group for group in groups if now - dates[group] >= freshness_ttl(website, group)]
+        if offer_groups:
+            stale[(isbn, website)] = offer_groups
+    return stale
+
+def stores_to_refresh(stale, websites=None):
+    """Split stale offers into (stores to scrape, stores whose prices alone are stale).
+
+    Stores in websites with no offer at all are scraped in full.
+    """
+    groups = {}
+    for (_, website), offer_groups in stale.items():
+        groups.setdefault(website, set()).update(offer_groups)
+    for website in websites or ():
+        groups.setdefault(website, set(FIELD_GROUPS))
+    stores = [website for website in STORE_REGISTRY if website in groups]
+    return stores, [website for website in stores if groups[website] == {"price"}]
+
+def title_stores_to_refresh(checked):
+    """(stores to scrape, price-only stores) for a title, given last_checked of its rows.
+
+    A title search can only re-read prices reliably (its offers may come
+    from result cards), so only price staleness counts; metadata is
+    refreshed by ISBN from the book page. A title with nothing stored is
+    scraped from every store.
+    """
+    if not checked:
+        return list(STORE_REGISTRY), []
+    return stores_to_refresh(stale_groups(checked, ("price",)))
+
+def save_book_data(book_data, price_only=()):
+    """Insert scraped store rows into the database.
+
+    Stores in price_only were scraped for prices alone: their offers update
+    the stored row in place rather than adding one, keyed by ISBN (see
+    upsert_offers) or, without one, by title, and only their price group is
+    marked as fetched.
+    """
+    by_isbn = {}
+    for item in book_data:
+        if item[4] in price_only and item[1] not in MISSING_VALUES:
+            by_isbn.setdefault(item[1], []).append(item)
+    for isbn, offers in by_isbn.items():
+        upsert_offers(isbn, offers, price_only)
+    now = datetime.now()
+    with orm.db_session:
+        record_checked([item for item in book_data if item[4] not in price_only], now=now)
+        for item in book_data:
+            if item[4] in price_only:
+                if item[1] in MISSING_VALUES:
+                    update_price_by_title(item)
+                continue
+            # Debug each item being saved
+            logger.info(f"Saving book: {item[0]}, price: {item[5]}, website: {item[4]}")
+            
+            BookPrice(
+                book_name=item[0], isbn=item[1], author=item[2], image_url=item[3],
+                website=item[4], price=item[5], rating=item[6], description=item[7],
+                date_created=now, genre=item[8], binding=item[9], language=item[10]
+            )
+
+def update_price_by_title(item):
+    """Update the price on the store's newest row of an ISBN-less offer's title.
+
+    A row without an ISBN has no freshness record, so its date moves on
+    too. Inserts the offer if there is no row. Call inside a db_session.
+    """
+    row = orm.select(b for b in BookPrice if b.website == item[4] and b.book_name == item[0]) \
+        .order_by(orm.desc(BookPrice.date_created)).first()
+    if row is None:
+        BookPrice(**dict(zip(BOOK_FIELDS, item), date_created=datetime.now()))
+    elif row.isbn in MISSING_VALUES:
+        row.set(price=item[5], date_created=datetime.now())
+    else:
+        row.set(price=item[5])
+        stamp_checked(row.isbn, row.website, ("price",))
+
+# Rows saved from a scrape land within this long of its product page fetch
+ARCHIVE_MATCH_WINDOW = timedelta(minutes=10)
+# Parallel workers for re-extraction; parsing is CPU bound, so these are processes
+REEXTRACT_WORKERS = os.cpu_count() or 2
+
+def reextract_archived(item):
+    """Run the current extractor over one archived page (in a worker process)."""
+    page_id, website, content_hash, book_name = item
+    try:
+        return page_id, parse_product(website, page_archive.get(content_hash), book_name), None
+    except Exception as e:
+        return page_id, None, str(e)
+
+def quiet_worker():
+    # Per-field extraction logs from every worker would drown the summary
+    logging.disable(logging.WARNING)
+
+def rows_for_archived_page(page):
+    """BookPrice rows saved from the scrape that fetched an archived page."""
+    rows = orm.select(b for b in BookPrice if b.website == page.website and
+                      b.date_created >= page.fetched and b.date_created <= page.fetched + ARCHIVE_MATCH_WINDOW)
+    if page.isbn and page.isbn != "Unknown":
+        return [row for row in rows if row.isbn == page.isbn]
+    return [row for row in rows if row.book_name == page.book_name]
+
+def reextract_changes(row, fields):
+    """Fields of a row a re-extracted page should change. Call inside a db_session.
+
+    Like upsert_offers, values the extractor could not read are skipped, and
+    so are fields fetched again since the row was saved from the page.
+    """
+    refreshed = {field for group in refreshed_groups(row) for field in FIELD_GROUPS[group]}
+    return {
+        field: value for field, value in fields.items()
+        if field not in refreshed and value not in MISSING_VALUES and getattr(row, field) != value
+        # A price or rating of 0 means the page showed none
+        and not (field in ("price", "rating") and not value)
+    }
+
+def reextract_rows(website=None, since=None, workers=REEXTRACT_WORKERS, dry_run=False):
+    """Re-extract archived product pages and update the rows scraped from them.
+
+    Pages are applied oldest first, so a row scraped more than once ends up
+    with what its newest page yields. Returns (pages re-extracted, rows
+    updated, pages that failed).
+    """
+    with orm.db_session:
+        query = orm.select(p for p in ArchivedPage).order_by(ArchivedPage.fetched)
+        if website:
+            query = query.filter(lambda p: p.website == website)
+        if since:
+            query = query.filter(lambda p: p.fetched >= since)
+        items = [(p.id, p.website, p.content_hash, p.book_name) for p in query]
+    logger.info(f"Re-extracting {len(items)} archived pages with {workers} workers")
+
+    pages = updated = failed = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=quiet_worker) as pool:
+        results = pool.map(reextract_archived, items, chunksize=16)
+        # One transaction for the whole batch
+        with orm.db_session:
+            for page_id, offer, error in results:
+                if error:
+                    failed += 1
+                    logger.warning(f"Could not re-extract archived page {page_id}: {error}")
+                    continue
+                pages += 1
+                page = ArchivedPage[page_id]
+                fields = dict(zip(BOOK_FIELDS, offer))
+                for row in rows_for_archived_page(page):
+                    changes = reextract_changes(row, fields)
+                    if changes:
+                        updated += 1
+                        logger.info(f"Row {row.id} ({page.website}, {page.isbn}): {', '.join(changes)} changed")
+                        if not dry_run:
+                            row.set(**changes)
+                if not dry_run:
+                    page.set(**{field: fields[field] for field in ("book_name", "isbn")
+                                if fields[field] not in MISSING_VALUES})
+            if dry_run:
+                orm.rollback()
+    return pages, updated, failed
+
+def reextract_command(argv):
+    parser = argparse.ArgumentParser(prog="app4.py reextract",
+                                     description="Re-run the current extractors over archived product pages")
+    parser.add_argument("--store", choices=list(STORE_REGISTRY), help="only pages from this store")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="only pages fetched on or after this date")
+    parser.add_argument("--workers", type=int, default=REEXTRACT_WORKERS)
+    parser.add_argument("--dry-run", action="store_true", help="report the changes without saving them")
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    pages, updated, failed = reextract_rows(args.store, args.since, args.workers, args.dry_run)
+    print(f"Re-extracted {pages} pages in {time.perf_counter() - start:.1f}s: "
+          f"{updated} rows {'would change' if args.dry_run else 'updated'}, {failed} pages failed")
+
+def normalize_query(query):
+    """Canonical form of a search query, used to key in-flight scrapes."""
+    return " ".join(query.lower().split())
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one in-flight task.
+
+    Only used on the scrape engine loop, so the task table needs no lock.
+    Every caller for a key awaits the same task and gets the same result.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+
+    async def do(self, key, make_coro):
+        task = self.tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(make_coro())
+            self.tasks[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            logger.info(f"Joining in-flight scrape for {key}")
+        # Shield so one waiter giving up does not cancel the scrape for the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self.tasks.get(key) is task:
+            del self.tasks[key]
+
+scrape_flights = SingleFlight()
+
+async def scrape_and_save_async(query, stores=None, price_only=(), deadline=None):
+    """Scrape a query and save the rows, once per normalized query in flight.
+
+    stores and price_only narrow the scrape as in scrape_book_async. With a
+    time.monotonic() deadline the offers that arrived in time are saved and
+    returned, and stores still running save their own offers when they land.
+    Callers joining a scrape already in flight share its deadline.
+    """
+    async def scrape_and_save():
+        book_data = await scrape_book_async(query, deadline, stores, price_only)
+        # Pony's db_session blocks, so keep it off the event loop
+        await asyncio.to_thread(save_book_data, book_data, price_only)
+        refresh_scheduler.mark_fresh(query, book_data)
+        return book_data
+    return await scrape_flights.do(f"query:{normalize_query(query)}", scrape_and_save)
+
+def isbn_last_checked(isbn):
+    with orm.db_session:
+        return last_checked(orm.select(b for b in BookPrice if b.isbn == isbn))
+
+def recently_not_sold(isbn, websites):
+    """Stores among websites checked lately and found not to sell the ISBN."""
+    now = datetime.now()
+    with orm.db_session:
+        return [
+            entry.website for entry in OfferFreshness.select(lambda f: f.isbn == isbn and f.website in websites)
+            if entry.price_checked and now - entry.price_checked < freshness_ttl(entry.website, "price")
+        ]
+
+def stale_stores(isbn, checked=None):
+    """(stores to scrape, price-only stores) for an ISBN under the freshness policy.
+
+    Stores never checked for the ISBN are scraped in full; stores checked
+    and found not to sell it only once that check is stale.
+    """
+    checked = checked if checked is not None else isbn_last_checked(isbn)
+    missing = [website for website in STORE_REGISTRY if (isbn, website) not in checked]
+    not_sold = recently_not_sold(isbn, missing) if missing else []
+    missing = [website for website in missing if website not in not_sold]
+    return stores_to_refresh(stale_groups(checked), missing)
+
+def store_offer_for_isbn(isbn, offers, website):
+    """A store's offer for the ISBN among scraped offers, or None.
+
+    Prefers an offer carrying the ISBN; failing that the store's best match,
+    if it has no ISBN of its own to say it is a different edition.
+    """
+    priced = [item for item in offers if item[4] == website and item[5] > 0]
+    for item in priced:
+        if item[1] == isbn:
+            return item
+    if priced and priced[0][1] in MISSING_VALUES:
+        return priced[0]
+    return None
+
+def upsert_offers(isbn, offers, price_only=()):
+    """Update each store's row for an ISBN in place, inserting it if there is none.
+
+    Fields the new offer could not read keep their stored values, and
+    duplicate rows for the same store are folded into the updated one. Rows
+    of stores in price_only only have their price updated.
+    """
+    now = datetime.now()
+    with orm.db_session:
+        for item in offers:
+            rows = list(orm.select(b for b in BookPrice if b.isbn == isbn and b.website == item[4])
+                        .order_by(orm.desc(BookPrice.date_created)))
+            values = dict(zip(BOOK_FIELDS, item), isbn=isbn, date_created=now)
+            if not rows:
+                BookPrice(**values)
+                continue
+            if item[4] in price_only:
+                values = {"price": item[5]}
+            # A rating of 0 means the page showed none
+            rows[0].set(**{field: value for field, value in values.items()
+                           if value not in MISSING_VALUES and not (field == "rating" and not value)})
+            for row in rows[1:]:
+                row.delete()
+        stamped = [type(item)(item[:1] + (isbn,) + item[2:]) for item in offers]
+        record_checked([item for item in stamped if item[4] not in price_only], now=now)
+        record_checked([item for item in stamped if item[4] in price_only], ("price",), now)
+
+def record_not_sold(isbn, websites):
+    """Mark stores that answered without the ISBN as checked for it."""
+    with orm.db_session:
+        for website in websites:
+            stamp_checked(isbn, website)
+
+def isbn_results(isbn, stores, results):
+    """Sort per-store scrape results for an ISBN into (offers, stores not selling it, stores that did not answer)."""
+    offers, not_sold, failed = [], [], []
+    for website in stores:
+        items = results.get(website, [])
+        offer = store_offer_for_isbn(isbn, items, website)
+        if offer:
+            offers.append(offer)
+        elif answered(items):
+            not_sold.append(website)
+        else:
+            failed.append(website)
+    return offers, not_sold, failed
+
+async def refresh_isbn_async(isbn, book_name):
+    """Re-scrape the stale stores of a known book, once per ISBN in flight.
+
+    Only stores whose offer is missing or stale under the freshness policy
+    are fetched, for their prices alone where the metadata is still fresh,
+    and their rows are updated in place. A store that fails keeps its last
+    good row. One that answers without the book keeps any row it had and is
+    recorded as checked, so it is not asked again until that goes stale.
+    Returns (stores fetched, stores updated, stores that did not answer).
+    """
+    async def refresh():
+        stores, price_only = await asyncio.to_thread(stale_stores, isbn)
+        if not stores:
+            logger.info(f"All store offers for {isbn} are fresh")
+            return [], [], []
+        logger.info(f"Refreshing {', '.join(stores)} for '{book_name}' (ISBN: {isbn}), "
+                    f"prices only for {', '.join(price_only) or 'none'}")
+        results, _ = await scrape_stores_async(book_name, stores=stores, price_only=price_only, isbn=isbn)
+        offers, not_sold, failed = isbn_results(isbn, stores, results)
+        await asyncio.to_thread(upsert_offers, isbn, offers, price_only)
+        await asyncio.to_thread(record_not_sold, isbn, not_sold)
+        refresh_scheduler.mark_fresh(book_name, offers)
+        return stores, [offer[4] for offer in offers], failed
+    return await scrape_flights.do(f"isbn:{isbn}", refresh)
+
+# Stale-while-revalidate. Pages are served from the database straight away,
+# stale or not; stale offers are refreshed in the background for the next
+# view. Only a cold miss, with nothing stored yet, waits on the stores, and
+# for at most COLD_MISS_DEADLINE seconds
+COLD_MISS_DEADLINE = float(os.environ.get("COLD_MISS_DEADLINE", 8))
+# Seconds a cold miss waits past its deadline for the offers in by then to be saved
+COLD_MISS_SAVE_GRACE = 1
+
+def prices_as_of(checked):
+    """When the stalest of the offers' prices was fetched, or None if unknown."""
+    dates = [dates["price"] for dates in checked.values() if dates["price"] != datetime.min]
+    return min(dates) if dates else None
+
+def scrape_cold_miss(query):
+    """Scrape and save a query nothing is stored for, waiting at most COLD_MISS_DEADLINE.
+
+    Stores that miss the deadline keep going and save their offers in the
+    background. A scrape of the query already in flight (a background job,
+    say) is joined with its own deadline, if it has one, so the wait is also
+    bounded here; the scrape carries on and whatever it has saved by then
+    is what the caller finds.
+    """
+    logger.info(f"Cold miss for '{query}', waiting up to {COLD_MISS_DEADLINE}s for the stores")
+    try:
+        return scrape_engine.run(scrape_and_save_async(query, deadline=time.monotonic() + COLD_MISS_DEADLINE),
+                                 timeout=COLD_MISS_DEADLINE + COLD_MISS_SAVE_GRACE)
+    except FutureTimeoutError:
+        logger.info(f"Cold miss for '{query}' joined a scrape still running, serving what is saved so far")
+        return []
+    except Exception as e:
+        logger.error(f"Error scraping '{query}' on a cold miss: {e}")
+        return []
+
+def revalidate_isbn(isbn, book_name):
+    """Refresh an ISBN's stale offers in the background, once per ISBN in flight.
+
+    Returns (prices as of, whether a refresh was started).
+    """
+    checked = isbn_last_checked(isbn)
+    stores, _ = stale_stores(isbn, checked)
+    if stores:
+        scrape_engine.submit(refresh_isbn_async(isbn, book_name))
+    return prices_as_of(checked), bool(stores)
+
+# Number of background scrape jobs allowed to run at once
+MAX_SCRAPE_JOBS = 4
+# How many jobs to remember for the status endpoint
+SCRAPE_JOB_HISTORY = 500
+
+class ScrapeJobs:
+    """Queue of background scrape jobs run on the scrape engine loop.
+
+    Handlers submit a query and get a job id back straight away; the scrape
+    and the database write happen in the background and callers poll
+    status() for the outcome.
+    """
+
+    def __init__(self, max_jobs=MAX_SCRAPE_JOBS, history=SCRAPE_JOB_HISTORY):
+        self.history = history
+        self.jobs = OrderedDict()
+        # Normalized query -> id of its queued or running job
+        self.active = {}
+        self.slots = asyncio.Semaphore(max_jobs)
+        self._lock = threading.Lock()
+
+    def submit(self, query, stores=None, price_only=()):
+        """Queue a scrape of query (optionally narrowed as in scrape_book_async) and return its job id."""
+        key = normalize_query(query)
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            # Hand back the existing job if this query is already queued or running
+            if key in self.active:
+                logger.info(f"Reusing scrape job {self.active[key]} for '{query}'")
+                return self.active[key]
+            self.active[key] = job_id
+            self.jobs[job_id] = {
+                'id': job_id,
+                'query': query,
+                'status': 'queued',
+                'submitted': datetime.now(),
+                'started': None,
+                'finished': None,
+                'offers': 0,
+                'error': None,
+            }
+            # Forget the oldest jobs once the history is full
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+        scrape_engine.submit(self._run(job_id, query, stores, price_only))
+        logger.info(f"Queued scrape job {job_id} for '{query}'")
+        return job_id
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self.jobs:
+                self.jobs[job_id].update(fields)
+
+    async def _run(self, job_id, query, stores, price_only):
+        async with self.slots:
+            self._update(job_id, status='running', started=datetime.now())
+            try:
+                book_data = await scrape_and_save_async(query, stores, price_only)
+                self._update(job_id, status='done', finished=datetime.now(), offers=len(book_data))
+                logger.info(f"Scrape job {job_id} for '{query}' saved {len(book_data)} offers")
+            except Exception as e:
+                logger.error(f"Scrape job {job_id} for '{query}' failed: {e}")
+                self._update(job_id, status='failed', finished=datetime.now(), error=str(e))
+            finally:
+                with self._lock:
+                    self.active.pop(normalize_query(query), None)
+
+    def status(self, job_id):
+        """Return a copy of the job record, or None for an unknown job."""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+scrape_jobs = ScrapeJobs()
+
+
+# Batch scraping (python app4.py batch FILE|-): entries scraped at once, and
+# entries saved per database transaction
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 8))
+BATCH_COMMIT_SIZE = 50
+# An entry every store skipped with its circuit open goes back in the queue
+# after a breaker's open time, at most this many times
+BATCH_REQUEUES = 3
+
+def batch_entry(line):
+    """Parse an input line into (checkpoint key, query, ISBN or None).
+
+    Lines holding an ISBN-10 or ISBN-13 (hyphens allowed) are looked up by
+    ISBN, anything else as a title. Blank lines and # comments give None.
+    """
+    text = line.strip()
+    if not text or text.startswith("#"):
+        return None
+    digits = text.replace("-", "").replace(" ", "").upper()
+    if re.fullmatch(r'\d{13}|\d{9}[\dX]', digits):
+        isbn = digits if len(digits) == 13 else isbn10_to_13(digits)
+        return f"isbn:{isbn}", isbn, isbn
+    return f"query:{normalize_query(text)}", text, None
+
+def read_checkpoint(path):
+    """Keys of the entries a previous run finished."""
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+def known_book_name(isbn):
+    with orm.db_session:
+        return orm.select(b.book_name for b in BookPrice if b.isbn == isbn).first()
+
+def batch_stores_to_refresh(query, isbn, stored):
+    """(stores to scrape, price-only stores) for a batch entry under the freshness policy.
+
+    stored says whether the entry's ISBN is already in the catalog. A title
+    is judged by the rows whose name contains it, as /book-by-name does.
+    """
+    if isbn:
+        return stale_stores(isbn) if stored else (list(STORE_REGISTRY), [])
+    with orm.db_session:
+        rows = orm.select(b for b in BookPrice if normalize_query(query) in b.book_name.lower())
+        return title_stores_to_refresh(last_checked(rows))
+
+def save_new_offers(offers, price_only=()):
+    """Save offers, updating the store's row for an ISBN already stored and inserting the rest."""
+    inserts = []
+    with orm.db_session:
+        for item in offers:
+            if item[1] not in MISSING_VALUES and \
+                    orm.exists(b for b in BookPrice if b.isbn == item[1] and b.website == item[4]):
+                upsert_offers(item[1], [item], price_only)
+            else:
+                inserts.append(item)
+        save_book_data(inserts, price_only)
+
+def commit_batch(results, checkpoint):
+    """Save the offers of finished entries in one transaction, then checkpoint them.
+
+    results holds (key, ISBN if already stored, offers, price-only stores,
+    stores found not to sell the ISBN) per entry. Offers of stored ISBNs
+    update their rows in place; only new offers are inserted. Entries are
+    only checkpointed once their rows are committed, so a crash in between
+    means they are scraped again, never lost.
+    """
+    with orm.db_session:
+        for _, isbn, offers, price_only, not_sold in results:
+            if isbn:
+                upsert_offers(isbn, offers, price_only)
+                record_not_sold(isbn, not_sold)
+            else:
+                save_new_offers(offers, price_only)
+    with open(checkpoint, "a", encoding="utf-8") as f:
+        f.writelines(f"{key}\n" for key, *_ in results)
+        f.flush()
+        os.fsync(f.fileno())
+
+async def batch_scrape_async(entries, checkpoint, concurrency=BATCH_CONCURRENCY, commit_size=BATCH_COMMIT_SIZE):
+    """Scrape batch entries on the engine loop with a fixed number of workers.
+
+    Store requests go through the usual fetch layer, so per-host rate limits,
+    circuit breakers and the HTTP cache all apply. Entries already in the
+    catalog only have their stale stores scraped, under the freshness
+    policy, and nothing at all when every offer is fresh. An entry no store
+    answered for counts as failed and stays out of the checkpoint, so a
+    rerun retries it; one only skipped by open circuits is first requeued
+    (BATCH_REQUEUES). Returns a stats dict.
+    """
+    pending = deque(entries)
+    finished = []
+    requeues = {}
+    stats = {'done': 0, 'offers': 0, 'failed': 0}
+    commit_lock = asyncio.Lock()
+    start = time.monotonic()
+
+    async def commit():
+        async with commit_lock:
+            if not finished:
+                return
+            batch = finished[:]
+            del finished[:]
+            await asyncio.to_thread(commit_batch, batch, checkpoint)
+            stats['done'] += len(batch)
+            stats['offers'] += sum(len(offers) for _, _, offers, _, _ in batch)
+            per_minute = stats['done'] * 60 / max(time.monotonic() - start, 1e-9)
+            print(f"{stats['done']}/{len(entries)} entries, {stats['offers']} offers saved, "
+                  f"{stats['failed']} failed, {per_minute:.1f} entries/min", flush=True)
+
+    async def worker():
+        while pending:
+            key, query, isbn = pending.popleft()
+            try:
+                known = await asyncio.to_thread(known_book_name, isbn) if isbn else None
+                book_name = known or query
+                stores, price_only = await asyncio.to_thread(batch_stores_to_refresh, query, isbn, bool(known))
+                # Every offer fresh: done without a fetch
+                results = {}
+                if stores:
+                    results, _ = await scrape_stores_async(book_name, stores=stores, price_only=price_only, isbn=isbn)
+            except Exception as e:
+                logger.error(f"Batch entry '{query}' failed: {e}")
+                stats['failed'] += 1
+                continue
+            if stores and not any(answered(items) for items in results.values()):
+                if all(offer.skipped for items in results.values() for offer in items) and \
+                        requeues.get(key, 0) < BATCH_REQUEUES:
+                    requeues[key] = requeues.get(key, 0) + 1
+                    logger.error(f"Batch entry '{query}': every store's circuit is open, retrying later")
+                    await asyncio.sleep(BREAKER_OPEN_SECONDS)
+                    pending.append((key, query, isbn))
+                    continue
+                logger.error(f"Batch entry '{query}' failed: no store answered")
+                stats['failed'] += 1
+                continue
+            if not stores:
+                finished.append((key, None, [], (), ()))
+            elif known:
+                offers, not_sold, _ = isbn_results(isbn, stores, results)
+                finished.append((key, isbn, offers, price_only, not_sold))
+            else:
+                offers = select_offers(book_name, results)
+                # Keep real offers, not the placeholder for a book no store had
+                offers = [offer for offer in offers if offer[5] > 0 or offer[0] != book_name]
+                finished.append((key, None, offers, price_only, ()))
+            if len(finished) >= commit_size:
+                await commit()
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    await commit()
+    return stats
+
+def batch_command(argv):
+    parser = argparse.ArgumentParser(prog="app4.py batch",
+                                     description="Scrape a list of titles or ISBNs (one per line) into the database")
+    parser.add_argument("file", help="input file, or - to read stdin")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="entries scraped at once")
+    parser.add_argument("--commit-size", type=int, default=BATCH_COMMIT_SIZE, help="entries saved per transaction")
+    parser.add_argument("--checkpoint", help="file of finished entries, for resuming "
+                                             "(default: FILE.checkpoint, or batch.checkpoint for stdin)")
+    parser.add_argument("--verbose", action="store_true", help="log every fetch, field and extraction warning")
+    args = parser.parse_args(argv)
+    if not args.verbose:
+        # Keep the progress lines readable; errors are still logged
+        logging.disable(logging.WARNING)
+
+    if args.file == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(args.file, encoding="utf-8") as f:
+            lines = f.readlines()
+    checkpoint = args.checkpoint or ("batch.checkpoint" if args.file == "-" else f"{args.file}.checkpoint")
+    seen = read_checkpoint(checkpoint)
+    skipped = len(seen)
+    entries = []
+    for line in lines:
+        entry = batch_entry(line)
+        if entry and entry[0] not in seen:
+            seen.add(entry[0])
+            entries.append(entry)
+    print(f"{len(entries)} entries to scrape, {skipped} already done according to {checkpoint}")
+
+    start = time.perf_counter()
+    try:
+        stats = scrape_engine.run(batch_scrape_async(entries, checkpoint, args.concurrency, args.commit_size))
+    except KeyboardInterrupt:
+        print(f"Interrupted; rerun with the same checkpoint ({checkpoint}) to carry on")
+        return
+    print(f"Scraped {stats['done']} entries in {time.perf_counter() - start:.1f}s: "
+          f"{stats['offers']} offers saved, {stats['failed']} failed (rerun to retry them)")
+
+# Titles the site promotes; /random picks from these and the refresh
+# scheduler keeps them fresh whether or not anyone has searched lately
+POPULAR_BOOKS = [
+    "Harry Potter and the Philosopher's Stone",
+    "To Kill a Mockingbird",
+    "The Great Gatsby",
+    "Pride and Prejudice",
+    "The Alchemist",
+    "1984",
+    "The Lord of the Rings",
+    "The Hobbit",
+    "The Catcher in the Rye",
+    "The Da Vinci Code",
+    "Atomic Habits",
+    "Rich Dad Poor Dad",
+    "Ikigai",
+    "The Psychology of Money",
+    "Think and Grow Rich"
+]
 
 def get_random_book():
-    popular_books = [
-        "Harry Potter and the Philosopher's Stone",
-        "To Kill a Mockingbird",
-        "The Great Gatsby",
-        "Pride and Prejudice",
-        "The Alchemist",
-        "1984",
-        "The Lord of the Rings",
-        "The Hobbit",
-        "The Catcher in the Rye",
-        "The Da Vinci Code",
-        "Atomic Habits",
-        "Rich Dad Poor Dad",
-        "Ikigai",
-        "The Psychology of Money",
-        "Think and Grow Rich"
-    ]
-    return random.choice(popular_books)
+    return random.choice(POPULAR_BOOKS)
+
+# Background refresh of popular titles. Set REFRESH_SCHEDULER=0 to rely on
+# the lazy re-scrape in search() alone
+REFRESH_SCHEDULER = os.environ.get("REFRESH_SCHEDULER", "1") == "1"
+# Crawl budget: background re-scrapes allowed per hour, across all titles
+REFRESH_BUDGET = int(os.environ.get("REFRESH_BUDGET", 60))
+# Seconds between scheduler passes
+REFRESH_INTERVAL = int(os.environ.get("REFRESH_INTERVAL", 60))
+# A title is never re-scraped more often than this, however popular
+REFRESH_MIN_AGE = timedelta(hours=1)
+# Lookups lose half their weight over this many seconds
+POPULARITY_HALF_LIFE = 24 * 3600
+# Standing popularity of a POPULAR_BOOKS title, in lookups, on top of real ones
+POPULAR_BOOK_WEIGHT = 5.0
+# Titles tracked at once; the least popular are dropped beyond this
+REFRESH_MAX_TITLES = 1000
+
+def title_price_ttl(websites):
+    """How long a title's prices stay fresh: the shortest price TTL of the stores selling it."""
+    return min((freshness_ttl(website, "price") for website in websites),
+               default=timedelta(seconds=DEFAULT_FRESHNESS["price"]))
+
+def store_volatility(websites):
+    """Volatility of a title: that of the most volatile store selling it."""
+    return max((STORE_REGISTRY.get(w, {}).get("volatility", 1.0) for w in websites), default=1.0)
+
+class RefreshScheduler:
+    """Re-scrapes the most looked-up titles in the background before they go stale.
+
+    Lookups are counted per normalized title with exponential decay. Each
+    pass ranks the tracked titles whose prices are past their stores'
+    freshness TTL by popularity x staleness x store volatility in a heap
+    and submits scrape jobs for the stale stores of the top ones, as far as
+    the hourly crawl budget allows.
+    """
+
+    def __init__(self, budget=REFRESH_BUDGET, interval=REFRESH_INTERVAL):
+        self.interval = interval
+        # Burst of one pass's share, so a restart does not spend an hour's budget at once
+        self.budget = TokenBucket(budget / 3600, max(1.0, budget * interval / 3600))
+        # Normalized title -> {'query', 'score', 'seen', 'floor', 'refreshed', 'websites', 'submitted'}
+        self.titles = {}
+        self.refreshes = 0
+        self.started = False
+        self._lock = threading.Lock()
+        for title in POPULAR_BOOKS:
+            self._track(title)["floor"] = POPULAR_BOOK_WEIGHT
+
+    def _track(self, query):
+        key = normalize_query(query)
+        entry = self.titles.get(key)
+        if entry is None:
+            entry = self.titles[key] = {
+                'query': query, 'score': 0.0, 'seen': time.time(), 'floor': 0.0,
+                # None until the database has been asked when the title was last scraped
+                'refreshed': None, 'websites': (), 'submitted': None,
+            }
+        return entry
+
+    def _popularity(self, entry, now):
+        return entry['floor'] + entry['score'] * 0.5 ** ((now - entry['seen']) / POPULARITY_HALF_LIFE)
+
+    def record_lookup(self, query):
+        """Count a user looking at a title."""
+        if not query:
+            return
+        now = time.time()
+        with self._lock:
+            entry = self._track(query)
+            entry['score'] = entry['score'] * 0.5 ** ((now - entry['seen']) / POPULARITY_HALF_LIFE) + 1
+            entry['seen'] = now
+            if len(self.titles) > REFRESH_MAX_TITLES:
+                coldest = min(self.titles, key=lambda key: self._popularity(self.titles[key], now))
+                del self.titles[coldest]
+
+    def mark_fresh(self, query, book_data):
+        """Note that a title was just scraped, by the scheduler or anyone else."""
+        with self._lock:
+            entry = self.titles.get(normalize_query(query))
+            if entry is not None:
+                entry['refreshed'] = datetime.now()
+                entry['websites'] = tuple({offer[4] for offer in book_data if offer[5] > 0}) or entry['websites']
+
+    def _title_rows(self, key):
+        return orm.select(b for b in BookPrice if key in b.book_name.lower())
+
+    def _load_freshness(self):
+        """Look up when the prices of titles new to the scheduler were last fetched."""
+        with self._lock:
+            unknown = [key for key, entry in self.titles.items() if entry['refreshed'] is None]
+        found = {}
+        with orm.db_session:
+            for key in unknown:
+                rows = list(self._title_rows(key))
+                found[key] = (prices_as_of(last_checked(rows)) or datetime.min,
+                              tuple({row.website for row in rows if row.price > 0}))
+        with self._lock:
+            for key, (refreshed, websites) in found.items():
+                if key in self.titles and self.titles[key]['refreshed'] is None:
+                    self.titles[key].update(refreshed=refreshed, websites=websites)
+
+    def stores_to_refresh(self, key):
+        """(stores to scrape, price-only stores) for a title under the freshness policy."""
+        with orm.db_session:
+            checked = last_checked(self._title_rows(key))
+            return title_stores_to_refresh(checked), prices_as_of(checked) or datetime.min
+
+    def priority(self, entry, now, wall_now):
+        """popularity x staleness x volatility, or 0 while the title's prices are fresh."""
+        age = wall_now - entry['refreshed']
+        ttl = title_price_ttl(entry['websites'])
+        if age < max(ttl, REFRESH_MIN_AGE):
+            return 0.0
+        if entry['submitted'] and wall_now - entry['submitted'] < REFRESH_MIN_AGE:
+            return 0.0
+        # Staleness in TTLs; never-scraped titles rank as ten TTLs stale
+        staleness = min(age / ttl, 10.0)
+        return self._popularity(entry, now) * staleness * store_volatility(entry['websites'])
+
+    def due(self):
+        """Heap of (-priority, key) for every title worth refreshing now."""
+        now, wall_now = time.time(), datetime.now()
+        with self._lock:
+            heap = [(-self.priority(entry, now, wall_now), key)
+                    for key, entry in self.titles.items() if entry['refreshed'] is not None]
+        heap = [item for item in heap if item[0] < 0]
+        heapq.heapify(heap)
+        return heap
+
+    async def run_once(self):
+        await asyncio.to_thread(self._load_freshness)
+        heap = self.due()
+        while heap:
+            priority, key = heapq.heappop(heap)
+            (stores, price_only), refreshed = await asyncio.to_thread(self.stores_to_refresh, key)
+            with self._lock:
+                entry = self.titles.get(key)
+                if entry is None:
+                    continue
+                if not stores:
+                    # Refreshed by other means since it was ranked
+                    entry['refreshed'] = refreshed
+                    continue
+                if not self.budget.try_take():
+                    break
+                entry['submitted'] = datetime.now()
+                query = entry['query']
+            logger.info(f"Background refresh of '{query}' from {', '.join(stores)} (priority {-priority:.2f})")
+            self.refreshes += 1
+            scrape_jobs.submit(query, stores, price_only)
+
+    async def run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Refresh scheduler pass failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Start the scheduler on the scrape engine loop, once."""
+        with self._lock:
+            if self.started:
+                return
+            self.started = True
+        scrape_engine.submit(self.run())
+        logger.info(f"Refresh scheduler started: {self.budget.rate * 3600:.0f} refreshes/hour, "
+                    f"every {self.interval}s")
+
+    def snapshot(self, limit=20):
+        """The scheduler's state and its most urgent titles, for the status endpoint."""
+        now, wall_now = time.time(), datetime.now()
+        with self._lock:
+            ranked = []
+            for entry in self.titles.values():
+                known = entry['refreshed'] is not None
+                ranked.append({
+                    'query': entry['query'],
+                    'popularity': round(self._popularity(entry, now), 2),
+                    'last_scraped': entry['refreshed'].isoformat() if known and entry['refreshed'] != datetime.min else None,
+                    'priority': round(self.priority(entry, now, wall_now), 2) if known else None,
+                })
+            tracked = len(self.titles)
+        ranked.sort(key=lambda item: (item['priority'] or 0, item['popularity']), reverse=True)
+        return {
+            'running': self.started,
+            'budget_per_hour': round(self.budget.rate * 3600),
+            'refreshes': self.refreshes,
+            'tracked_titles': tracked,
+            'titles': ranked[:limit],
+        }
+
+refresh_scheduler = RefreshScheduler()
 
 def get_all_genres():
     with orm.db_session:
@@ -868,6 +3232,13 @@ def check_database():
         logger.error(f"Database connection error: {e}")
         return False
 
+@app.before_request
+def start_refresh_scheduler():
+    # Started by the first request rather than at import, so the CLI
+    # commands and the debug reloader's watcher process never crawl
+    if REFRESH_SCHEDULER and not refresh_scheduler.started:
+        refresh_scheduler.start()
+
 # Routes
 @app.route('/')
 def home():
@@ -899,38 +3270,41 @@ def search():
     
     if not query:
         return redirect(url_for('home'))
+    refresh_scheduler.record_lookup(query)
+    
+    # Search in book name, author, and genre
+    def matching_books():
+        return orm.select(b for b in BookPrice if 
+                          query.lower() in b.book_name.lower() or 
+                          (b.author and query.lower() in b.author.lower()) or
+                          (b.genre and query.lower() in b.genre.lower()))
+    
+    # A cold miss waits (briefly) for the stores; anything else is served as
+    # stored while stale offers are re-scraped in the background. The page
+    # then polls the job status; the job id comes back in ?job= once it
+    # lands so it is not resubmitted. The wait happens outside the session
+    # below, whose reads would not see the rows saved meanwhile. A request
+    # that just scraped every store (stragglers still save in the
+    # background) submits no job of its own
+    previous_job = scrape_jobs.status(request.args.get('job', ''))
+    cold = False
+    if not previous_job:
+        with orm.db_session:
+            cold = not matching_books().exists()
+        if cold:
+            scrape_cold_miss(query)
     
     with orm.db_session:
-        # Search in book name, author, and genre
-        existing_books = list(orm.select(b for b in BookPrice if 
-                                        query.lower() in b.book_name.lower() or 
-                                        (b.author and query.lower() in b.author.lower()) or
-                                        (b.genre and query.lower() in b.genre.lower())))
+        existing_books = list(matching_books())
         
-        # If no books found or data is old, scrape new data
-        if not existing_books or (datetime.now() - existing_books[0].date_created).days >= 1:
-            logger.info(f"Scraping new data for '{query}'")
-            book_data = scrape_book(query)
-            
-            # Debug the scraped data
-            logger.info(f"Scraped data: {book_data}")
-            
-            with orm.db_session:
-                for item in book_data:
-                    # Debug each item being saved
-                    logger.info(f"Saving book: {item[0]}, price: {item[5]}, website: {item[4]}")
-                    
-                    BookPrice(
-                        book_name=item[0], isbn=item[1], author=item[2], image_url=item[3],
-                        website=item[4], price=item[5], rating=item[6], description=item[7],
-                        date_created=datetime.now(), genre=item[8], binding=item[9], language=item[10]
-                    )
-            
-            # Fetch the newly added books
-            existing_books = list(orm.select(b for b in BookPrice if 
-                                        query.lower() in b.book_name.lower() or 
-                                        (b.author and query.lower() in b.author.lower()) or
-                                        (b.genre and query.lower() in b.genre.lower())))
+        job_id = None
+        checked = last_checked(existing_books)
+        stores, price_only = title_stores_to_refresh(checked)
+        if previous_job and previous_job['status'] in ('queued', 'running'):
+            job_id = previous_job['id']
+        elif stores and not previous_job and not cold:
+            logger.info(f"Scraping new data for '{query}' from {', '.join(stores)}")
+            job_id = scrape_jobs.submit(query, stores, price_only)
         
         logger.info(f"Using existing data from database for '{query}'")
         
@@ -979,7 +3353,8 @@ def search():
     # Debug the final data being sent to template
     logger.info(f"Sending {len(unique_books)} unique books to search template")
     
-    return render_template('search.html', query=query, unique_books=unique_books, genres=genres, authors=authors)
+    return render_template('search.html', query=query, unique_books=unique_books, genres=genres, authors=authors,
+                           job_id=job_id, prices_as_of=prices_as_of(checked))
 
 # This is a snippet of the relevant functions that handle price data
 
@@ -1129,12 +3504,16 @@ def book_detail(isbn):
             flash("Book not found", "error")
             return redirect(url_for('home'))
     
+    refresh_scheduler.record_lookup(book_data[0][0])
+    # Serve the stored prices now and refresh stale ones for the next view
+    as_of, refreshing = revalidate_isbn(book_data[0][1], book_data[0][0])
     genres = get_all_genres()
     authors = get_all_authors()
     
     logging.info(f"Sending book data to product template: {book_data}")
     
-    return render_template('product.html', book_data=book_data, genres=genres, authors=authors)
+    return render_template('product.html', book_data=book_data, genres=genres, authors=authors,
+                           prices_as_of=as_of, refreshing=refreshing)
 
 @app.route('/refresh/<isbn>')
 def refresh_prices(isbn):
@@ -1150,26 +3529,58 @@ def refresh_prices(isbn):
             return redirect(url_for('home'))
         
         book_name = book.book_name
-        logging.info(f"Refreshing prices for '{book_name}' (ISBN: {isbn})")
-        
-        # Delete existing records for this book
-        orm.delete(b for b in BookPrice if b.isbn == isbn)
-        
-        # Scrape fresh data
-        book_data = scrape_book(book_name)
-        for item in book_data:
-            BookPrice(
-                book_name=item[0], isbn=item[1], author=item[2], image_url=item[3],
-                website=item[4], price=item[5], rating=item[6], description=item[7],
-                date_created=datetime.now(), genre=item[8], binding=item[9], language=item[10]
-            )
-        
-        flash("Prices refreshed successfully", "success")
+    
+    logging.info(f"Refreshing prices for '{book_name}' (ISBN: {isbn})")
+    
+    # Re-scrape only the stores whose offers are stale and update them in
+    # place; concurrent refreshes of the same ISBN share a single scrape
+    try:
+        stores, updated, failed = scrape_engine.run(refresh_isbn_async(isbn, book_name))
+        if not stores:
+            flash("Prices are already up to date", "success")
+        elif failed:
+            labels = ", ".join(STORE_REGISTRY[website]["label"] for website in failed)
+            flash(f"Prices refreshed, but {labels} could not be reached; showing the last known prices", "warning")
+        else:
+            flash("Prices refreshed successfully", "success")
+    except Exception as e:
+        logger.error(f"Error refreshing prices for {isbn}: {e}")
+        flash("Could not refresh prices, please try again later", "error")
     
     return redirect(url_for('book_detail', isbn=isbn))
 
+@app.route('/scrape-status/<job_id>')
+def scrape_status(job_id):
+    job = scrape_jobs.status(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown job'}), 404
+    for key in ('submitted', 'started', 'finished'):
+        if job[key]:
+            job[key] = job[key].isoformat()
+    return jsonify(job)
+
+@app.route('/scraper-metrics')
+def scraper_metrics_view():
+    metrics = scraper_metrics.snapshot()
+    for website, stats in store_breakers.snapshot().items():
+        metrics.setdefault(website, {}).update(stats)
+    for website, stats in store_latency.snapshot().items():
+        metrics.setdefault(website, {}).update(stats)
+    return jsonify(metrics)
+
+@app.route('/refresh-schedule')
+def refresh_schedule_view():
+    return jsonify(refresh_scheduler.snapshot())
+
 @app.route('/book_by_name/<book_name>')
 def book_by_name(book_name):
+    # Nothing stored yet: wait briefly for the stores (outside the session
+    # below, whose reads would not see the rows saved meanwhile)
+    with orm.db_session:
+        cold = not orm.exists(b for b in BookPrice if book_name.lower() in b.book_name.lower())
+    if cold:
+        scrape_cold_miss(book_name)
+    
     with orm.db_session:
         logger.info(f"Looking up book with name: {book_name}")
         
@@ -1180,6 +3591,14 @@ def book_by_name(book_name):
             logger.warning(f"No book found with name: {book_name}")
             flash("Book not found", "error")
             return redirect(url_for('home'))
+        refresh_scheduler.record_lookup(book_name)
+        
+        # Serve the stored prices now and re-scrape stale stores in the
+        # background, unless this request has just scraped them all
+        checked = last_checked(books_by_name)
+        stores, price_only = title_stores_to_refresh(checked)
+        if stores and not cold:
+            scrape_jobs.submit(book_name, stores, price_only)
         
         # Collect all entries for this book name
         book_data = list(orm.select((
@@ -1229,7 +3648,8 @@ def book_by_name(book_name):
     
     logger.info(f"Sending book data to product template: {book_data}")
     
-    return render_template('product.html', book_data=book_data, genres=genres, authors=authors)
+    return render_template('product.html', book_data=book_data, genres=genres, authors=authors,
+                           prices_as_of=prices_as_of(checked), refreshing=bool(stores))
 
 @app.route('/random')
 def random_book():
@@ -1496,6 +3916,12 @@ def debug_templates():
         return response
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['reextract']:
+        reextract_command(sys.argv[2:])
+        sys.exit()
+    if sys.argv[1:2] == ['batch']:
+        batch_command(sys.argv[2:])
+        sys.exit()
     # Check database connectivity before starting
     check_database()
     app.run(debug=True)
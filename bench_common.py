@@ -0,0 +1,23 @@
+"""Helpers shared by the benchmark and fixture scripts."""
+import logging
+import os
+import time
+
+# Recorded (or hand-written) store pages: fixtures/<store>/*.html plus expected.json
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def time_call(fn, repeat):
+    """Return the mean wall time of fn() in milliseconds."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def quiet_logs(level=logging.INFO):
+    """Silence log records up to level for the rest of the run.
+
+    The extractors log every field, which would swamp the timings.
+    """
+    logging.disable(level)
@@ -0,0 +1,75 @@
+"""Benchmark the HTML parser backends used by the store extractors.
+
+Usage:
+    python bench_parsers.py [page.html ...] [--repeat N] [--backends lxml selectolax]
+
+With no files, the debug captures saved by the scrapers are used
+(debug_captures/<store>/*.html.gz). Pages in a store's capture directory,
+or whose file name starts with a store name (amazon_, bookswagon_,
+kitabay_), are also parsed with the store's product page regions (partial
+parsing) and run through its product page extractor.
+"""
+import argparse
+import glob
+import gzip
+import os
+
+import app4
+from bench_common import quiet_logs, time_call
+
+
+def store_for(path):
+    name = os.path.basename(path).lower()
+    parent = os.path.basename(os.path.dirname(path)).lower()
+    for website in app4.STORE_REGISTRY:
+        if name.startswith(website) or parent == website:
+            return website
+    return None
+
+
+def read_page(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-page parse time of the HTML parser backends")
+    parser.add_argument("files", nargs="*", help="HTML pages to parse, plain or gzipped (default: the debug captures)")
+    parser.add_argument("--repeat", type=int, default=20, help="parses per page and backend")
+    parser.add_argument("--backends", nargs="+", default=list(app4.PARSER_BACKENDS), choices=app4.PARSER_BACKENDS)
+    args = parser.parse_args()
+
+    files = args.files or sorted(glob.glob(os.path.join(app4.DEBUG_CAPTURE_DIR, "*", "*.html.gz")))
+    if not files:
+        parser.error(f"no HTML pages given and no captures found in {app4.DEBUG_CAPTURE_DIR}")
+
+    quiet_logs()
+
+    print(f"{'page':<44} {'backend':<12} {'KB':>7} {'parse ms':>10} {'partial ms':>11} {'extract ms':>11}")
+    totals = {}
+    for path in files:
+        html = read_page(path)
+        website = store_for(path)
+        for backend in args.backends:
+            try:
+                parse_ms = time_call(lambda: app4.make_soup(html, backend=backend), args.repeat)
+            except Exception as e:
+                print(f"{os.path.basename(path):<44} {backend:<12} unavailable: {e}")
+                continue
+            partial = extract = ""
+            if website:
+                regions = app4.STORE_REGISTRY[website]["regions"]["product"]
+                partial = f"{time_call(lambda: app4.make_soup(html, regions, backend), args.repeat):.2f}"
+                app4.HTML_PARSER = backend
+                extract = f"{time_call(lambda: app4.parse_product(website, html, ''), args.repeat):.2f}"
+            totals.setdefault(backend, []).append(parse_ms)
+            print(f"{os.path.basename(path):<44} {backend:<12} {len(html) / 1024:>7.0f} {parse_ms:>10.2f} {partial:>11} {extract:>11}")
+
+    print()
+    for backend, times in totals.items():
+        print(f"{backend:<12} mean parse {sum(times) / len(times):.2f} ms over {len(times)} pages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""Local stand-in for the book stores, for end-to-end load tests.
+
+Usage:
+    python mock_stores.py serve [--port 8901] [--latency 0.3] [--slow-rate 0.02] [--slow-latency 4]
+                                [--error-rate 0.02] [--captcha-rate 0] [--throttle 20]
+    python mock_stores.py loadtest [--app http://127.0.0.1:5000] [--requests 200] [--concurrency 20]
+                                   [--cold-share 0.1] [--wait-jobs]
+
+serve starts one HTTP server per registered store, on consecutive ports,
+serving the recorded pages under fixtures/<store>/: the search page for the
+store's search path and the product page for anything else. Each response
+waits an exponentially distributed latency around --latency, a --slow-rate
+share of them waits --slow-latency instead, --error-rate of them fail with a
+500 or 503 and --captcha-rate of them get a bot-check page. With --throttle,
+each store answers requests beyond that many per second with 429 and a
+Retry-After, like a real store would.
+
+It prints the STORE_BASE_URLS line that points the app at it. Start the app
+with that set (and OVERRIDE_RATE_LIMIT=rate,burst to lift the per-store
+politeness budget, which would otherwise cap throughput), then run loadtest
+against it.
+
+loadtest follows the app's stale-while-revalidate flow. It first seeds the
+catalog by searching once for each book title on the fixture pages. Then it
+sends /search requests: a --cold-share of them for queries never seen
+before, which are cold misses that wait up to the app's COLD_MISS_DEADLINE
+for the stores, and the rest for the seeded titles, which are served from
+the database. It reports throughput and the latency percentiles of cold
+misses and warm hits separately. A warm hit whose offers are past their
+freshness TTL starts a background refresh job; with --wait-jobs each such
+job is followed to completion and its scrape time reported. Right after
+seeding every offer is fresh, so jobs only show up against an older
+catalog, e.g. a second run hours later.
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+
+import app4
+from bench_common import FIXTURES_DIR
+
+CAPTCHA_PAGE = (
+    "<html><head><title>Robot Check</title></head><body>"
+    "<p>Enter the characters you see below</p><form action=\"/errors/validateCaptcha\"></form>"
+    "</body></html>"
+)
+
+
+def search_path_prefix(config):
+    """Path prefix of a store's search URL, e.g. "/search-books/"."""
+    path = urlparse(config["search_url"].format(base_url="http://store", query="QUERY")).path
+    return path.split("QUERY")[0]
+
+
+class StoreBehaviour:
+    """Latency, error and throttling settings shared by every mock store."""
+
+    def __init__(self, args):
+        self.latency = args.latency
+        self.slow_rate = args.slow_rate
+        self.slow_latency = args.slow_latency
+        self.error_rate = args.error_rate
+        self.captcha_rate = args.captcha_rate
+        self.throttle = args.throttle
+
+    def delay(self):
+        if random.random() < self.slow_rate:
+            return self.slow_latency
+        return random.expovariate(1 / self.latency) if self.latency > 0 else 0
+
+
+class Throttle:
+    """Fixed one-second window request counter."""
+
+    def __init__(self, per_second):
+        self.per_second = per_second
+        self.window = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = int(time.time())
+            if now != self.window:
+                self.window = now
+                self.count = 0
+            self.count += 1
+            return self.count <= self.per_second
+
+
+def make_handler(website, behaviour):
+    with open(os.path.join(FIXTURES_DIR, website, "search.html"), encoding="utf-8") as f:
+        search_page = f.read().encode("utf-8")
+    with open(os.path.join(FIXTURES_DIR, website, "product.html"), encoding="utf-8") as f:
+        product_page = f.read().encode("utf-8")
+    prefix = search_path_prefix(app4.STORE_REGISTRY[website])
+    throttle = Throttle(behaviour.throttle) if behaviour.throttle else None
+
+    class MockStoreHandler(BaseHTTPRequestHandler):
+        # Keep-alive, so the app's connection pools behave as they do live
+        protocol_version = "HTTP/1.1"
+
+        def send_page(self, status, body, extra_headers=()):
+            self.send_response(status)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in extra_headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if throttle and not throttle.allow():
+                self.send_page(429, b"Too many requests", [("Retry-After", "1")])
+                return
+            time.sleep(behaviour.delay())
+            roll = random.random()
+            if roll < behaviour.error_rate:
+                self.send_page(random.choice((500, 503)), b"Service unavailable")
+            elif roll < behaviour.error_rate + behaviour.captcha_rate:
+                self.send_page(200, CAPTCHA_PAGE.encode("utf-8"))
+            elif urlparse(self.path).path.startswith(prefix):
+                self.send_page(200, search_page)
+            else:
+                self.send_page(200, product_page)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockStoreHandler
+
+
+def serve(args):
+    behaviour = StoreBehaviour(args)
+    servers = []
+    for offset, website in enumerate(app4.STORE_REGISTRY):
+        if not os.path.exists(os.path.join(FIXTURES_DIR, website, "search.html")):
+            print(f"Skipping {website}: no fixtures")
+            continue
+        server = ThreadingHTTPServer((args.host, args.port + offset), make_handler(website, behaviour))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append((website, f"http://{args.host}:{server.server_port}"))
+
+    for website, url in servers:
+        print(f"{website:<12} {url}")
+    print("\nPoint the app at these stores with:")
+    print(f'  STORE_BASE_URLS="{",".join(f"{website}={url}" for website, url in servers)}"')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0.0
+
+
+def wait_for_job(app_url, job_id, timeout):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        job = requests.get(f"{app_url}/scrape-status/{job_id}", timeout=10).json()
+        if job.get("status") in ("done", "failed"):
+            return job["status"], time.monotonic() - start
+        time.sleep(0.2)
+    return "timeout", time.monotonic() - start
+
+
+def fixture_titles():
+    """Book titles on the fixture pages, which the app has stored once they are searched for."""
+    titles = set()
+    for path in glob.glob(os.path.join(FIXTURES_DIR, "*", "expected.json")):
+        with open(path, encoding="utf-8") as f:
+            fixture = json.load(f)
+        names = [fixture.get("product", {}).get("fields", {}).get("book_name")]
+        names += [result.get("book_name") for result in fixture.get("search", {}).get("results", [])]
+        titles.update(name.lower() for name in names if name)
+    return sorted(titles)
+
+
+def loadtest(args):
+    run_id = int(time.time())
+    titles = fixture_titles()
+    if not titles:
+        raise SystemExit(f"no fixture titles found under {FIXTURES_DIR}")
+
+    # Seed the catalog, so searches for these titles are served from the database
+    start = time.monotonic()
+    for title in titles:
+        requests.get(f"{args.app}/search", params={"query": title}, timeout=60)
+    print(f"Seeded {len(titles)} titles in {time.monotonic() - start:.1f}s")
+
+    picker = random.Random(run_id)
+    plan = [picker.random() < args.cold_share for _ in range(args.requests)]
+
+    def one_search(i):
+        # Cold: a query never seen before, so it misses and waits on the stores
+        cold = plan[i]
+        query = f"load test {run_id} {i}" if cold else titles[i % len(titles)]
+        start = time.monotonic()
+        resp = requests.get(f"{args.app}/search", params={"query": query}, timeout=60)
+        latency = time.monotonic() - start
+        match = re.search(r"scrape-status/([0-9a-f]{32})", resp.text)
+        job = None
+        if match:
+            job = wait_for_job(args.app, match.group(1), args.job_timeout) if args.wait_jobs else ("started", 0.0)
+        return "cold" if cold else "warm", resp.status_code, latency, job
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(one_search, range(args.requests)))
+    elapsed = time.monotonic() - start
+
+    errors = sum(1 for _, status, _, _ in results if status != 200)
+    print(f"{len(results)} searches in {elapsed:.1f}s ({len(results) / elapsed:.1f}/s), {errors} non-200")
+    for kind, label in (("warm", "warm hits"), ("cold", "cold misses")):
+        latencies = [latency for result_kind, _, latency, _ in results if result_kind == kind]
+        if latencies:
+            print(f"{label:<12} {len(latencies):>5}  p50 {percentile(latencies, 50) * 1000:.0f} ms  "
+                  f"p95 {percentile(latencies, 95) * 1000:.0f} ms  p99 {percentile(latencies, 99) * 1000:.0f} ms  "
+                  f"max {max(latencies) * 1000:.0f} ms")
+    jobs = [job for _, _, _, job in results if job]
+    print(f"refresh jobs started by warm hits: {len(jobs)}")
+    if jobs and args.wait_jobs:
+        scrape_times = [seconds for status, seconds in jobs if status == "done"]
+        outcomes = {}
+        for status, _ in jobs:
+            outcomes[status] = outcomes.get(status, 0) + 1
+        print(f"scrape jobs      {outcomes}")
+        if scrape_times:
+            print(f"scrape time      p50 {percentile(scrape_times, 50):.2f}s  p95 {percentile(scrape_times, 95):.2f}s  "
+                  f"p99 {percentile(scrape_times, 99):.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock book stores and a /search load generator")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="serve the fixture pages as mock stores")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8901, help="port of the first store; the rest follow")
+    serve_parser.add_argument("--latency", type=float, default=0.3, help="mean response latency in seconds")
+    serve_parser.add_argument("--slow-rate", type=float, default=0.02, help="share of responses that are slow")
+    serve_parser.add_argument("--slow-latency", type=float, default=4.0, help="latency of slow responses in seconds")
+    serve_parser.add_argument("--error-rate", type=float, default=0.02, help="share of responses that are 500/503")
+    serve_parser.add_argument("--captcha-rate", type=float, default=0.0, help="share of responses that are CAPTCHA pages")
+    serve_parser.add_argument("--throttle", type=int, default=0, help="requests per second per store before 429s (0: off)")
+
+    load_parser = commands.add_parser("loadtest", help="send /search requests to a running app")
+    load_parser.add_argument("--app", default="http://127.0.0.1:5000")
+    load_parser.add_argument("--requests", type=int, default=200)
+    load_parser.add_argument("--concurrency", type=int, default=20)
+    load_parser.add_argument("--cold-share", type=float, default=0.1,
+                             help="share of requests for never-seen queries (cold misses)")
+    load_parser.add_argument("--wait-jobs", action="store_true", help="follow each background refresh job to completion")
+    load_parser.add_argument("--job-timeout", type=float, default=60.0)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args)
+    else:
+        loadtest(args)
+
+
+if __name__ == "__main__":
+    main()
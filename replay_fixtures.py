@@ -0,0 +1,212 @@
+"""Replay recorded store pages through the extractors, with no network.
+
+Usage:
+    python replay_fixtures.py [--stores amazon kitabay] [--backends lxml selectolax] [--repeat N]
+    python replay_fixtures.py --record STORE PAGE URL_OR_QUERY
+
+Each store has a directory under fixtures/ holding a search page, a product
+page and expected.json, which names the pages and lists the values the
+extractors should find on them:
+
+    {"query": "...",
+     "search": {"page": "search.html", "book_url": "...", "results": [{field: value}, ...]},
+     "product": {"page": "product.html", "fields": {field: value}}}
+
+For every page and parser backend the report gives the parse and extract
+time, the peak memory allocated while doing both (tracemalloc), and how many
+of the expected fields came out right. Mismatches are listed at the end.
+The fixtures shipped here are hand-written stubs of a few KB, so the
+timings are synthetic; record live pages with --record for realistic ones.
+
+--record fetches a live page through the app's fetch layer (HTTP cache, rate
+limits and all) and saves it as fixtures/STORE/PAGE.html; expected.json is
+then written by hand. PAGE "search" takes a query, anything else a URL.
+"""
+import argparse
+import json
+import logging
+import os
+import tracemalloc
+from urllib.parse import urlparse
+
+import app4
+from bench_common import FIXTURES_DIR, quiet_logs, time_call
+
+
+def peak_allocation(fn):
+    """Peak memory allocated while running fn(), in KiB."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def same_value(expected, actual):
+    if isinstance(expected, float) or isinstance(actual, float):
+        try:
+            return abs(float(expected) - float(actual)) < 0.01
+        except (TypeError, ValueError):
+            return False
+    return str(expected).strip() == str(actual).strip()
+
+
+def compare(label, expected, actual, mismatches):
+    """Count matching fields of one expected record; returns (right, total)."""
+    right = 0
+    for field, value in expected.items():
+        got = actual.get(field) if actual else None
+        if same_value(value, got):
+            right += 1
+        else:
+            mismatches.append(f"{label} {field}: expected {value!r}, got {got!r}")
+    return right, len(expected)
+
+
+def replay_search(website, html, expected, mismatches):
+    """Parse and extract a search page; returns (soup, check) where check scores it."""
+    regions = app4.page_regions(website, "search")
+
+    def parse():
+        return app4.make_soup(html, regions)
+
+    def extract(soup):
+        book_url = app4.find_book_url(website, html, expected.get("query", ""), soup)
+        harvested = app4.harvest_search_results(website, soup) if app4.STORE_REGISTRY[website].get("search_results") else []
+        return book_url, [fields for _, fields in harvested]
+
+    def check():
+        book_url, results = extract(parse())
+        right = total = 0
+        if "book_url" in expected:
+            total += 1
+            # Compare paths so a base_url override does not count as a miss
+            if book_url and urlparse(book_url).path == urlparse(expected["book_url"]).path:
+                right += 1
+            else:
+                mismatches.append(f"{website} search book_url: expected {expected['book_url']!r}, got {book_url!r}")
+        for i, record in enumerate(expected.get("results", [])):
+            got = results[i] if i < len(results) else None
+            r, t = compare(f"{website} search result {i + 1}", record, got, mismatches)
+            right += r
+            total += t
+        return right, total
+
+    return parse, extract, check
+
+
+def replay_product(website, html, expected, mismatches):
+    regions = app4.page_regions(website, "product")
+
+    def parse():
+        return app4.make_soup(html, regions)
+
+    def extract(soup):
+        return app4.extract_product(website, soup, expected.get("query", ""))
+
+    def check():
+        offer = dict(zip(app4.BOOK_FIELDS, extract(parse())))
+        return compare(f"{website} product", expected["fields"], offer, mismatches)
+
+    return parse, extract, check
+
+
+def load_fixture(website):
+    with open(os.path.join(FIXTURES_DIR, website, "expected.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_page(website, name):
+    with open(os.path.join(FIXTURES_DIR, website, name), encoding="utf-8") as f:
+        return f.read()
+
+
+async def fetch_page(website, url):
+    client = await app4.scrape_engine.get_client(website)
+    return await app4.fetch_text_async(client, url)
+
+def record(website, page, target):
+    url = target if target.startswith("http") else app4.store_search_url(website, target)
+    status, html = app4.scrape_engine.run(fetch_page(website, url))
+    path = os.path.join(FIXTURES_DIR, website, f"{page}.html")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(html)
+    print(f"Saved {url} ({status}, {len(html) / 1024:.0f} KB) to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay fixture pages through the store extractors")
+    parser.add_argument("--stores", nargs="+", help="stores to replay (default: every store with fixtures)")
+    parser.add_argument("--backends", nargs="+", default=list(app4.PARSER_BACKENDS), choices=app4.PARSER_BACKENDS)
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per page and backend")
+    parser.add_argument("--record", nargs=3, metavar=("STORE", "PAGE", "URL_OR_QUERY"),
+                        help="fetch a live page and save it as a fixture")
+    args = parser.parse_args()
+
+    if args.record:
+        record(*args.record)
+        return
+
+    stores = args.stores or [
+        website for website in app4.STORE_REGISTRY
+        if os.path.exists(os.path.join(FIXTURES_DIR, website, "expected.json"))
+    ]
+    if not stores:
+        parser.error(f"no fixtures found under {FIXTURES_DIR}")
+
+    quiet_logs(logging.WARNING)
+
+    pages = [
+        os.path.join(FIXTURES_DIR, website, fixture[kind]["page"])
+        for website, fixture in ((website, load_fixture(website)) for website in stores)
+        for kind in ("search", "product") if kind in fixture
+    ]
+    size_kb = sum(os.path.getsize(path) for path in pages) / 1024 / max(len(pages), 1)
+    print(f"Synthetic benchmark: {len(pages)} fixture pages averaging {size_kb:.1f} KB. Hand-written stubs are")
+    print("far smaller than live store pages, so the timings compare backends but do not predict production cost.\n")
+    print(f"{'page':<24} {'backend':<12} {'KB':>6} {'parse ms':>9} {'extract ms':>11} {'peak KiB':>9} {'fields':>8}")
+    mismatches = []
+    totals = {}
+    for website in stores:
+        fixture = load_fixture(website)
+        for kind, replay in (("search", replay_search), ("product", replay_product)):
+            if kind not in fixture:
+                continue
+            expected = dict(fixture[kind], query=fixture.get("query", ""))
+            html = read_page(website, expected["page"])
+            for backend in args.backends:
+                app4.HTML_PARSER = backend
+                # Only the first backend's mismatches are listed; the rest would repeat them
+                page_mismatches = mismatches if backend == args.backends[0] else []
+                try:
+                    parse, extract, check = replay(website, html, expected, page_mismatches)
+                    soup = parse()
+                except Exception as e:
+                    print(f"{website + ' ' + kind:<24} {backend:<12} unavailable: {e}")
+                    continue
+                parse_ms = time_call(parse, args.repeat)
+                extract_ms = time_call(lambda: extract(soup), args.repeat)
+                peak = peak_allocation(lambda: extract(parse()))
+                right, total = check()
+                stats = totals.setdefault(backend, [0.0, 0.0, 0, 0])
+                stats[0] += parse_ms
+                stats[1] += extract_ms
+                stats[2] += right
+                stats[3] += total
+                print(f"{website + ' ' + kind:<24} {backend:<12} {len(html) / 1024:>6.0f} {parse_ms:>9.2f} "
+                      f"{extract_ms:>11.2f} {peak:>9.0f} {f'{right}/{total}':>8}")
+
+    print()
+    for backend, (parse_ms, extract_ms, right, total) in totals.items():
+        accuracy = 100 * right / total if total else 0
+        print(f"{backend:<12} parse {parse_ms:.2f} ms, extract {extract_ms:.2f} ms, fields {right}/{total} ({accuracy:.0f}%)")
+    if mismatches:
+        print("\nMismatches:")
+        for line in mismatches:
+            print(f"  {line}")
+
+
+if __name__ == "__main__":
+    main()